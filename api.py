@@ -0,0 +1,178 @@
+''' A versioned JSON API over the same data the pages show, for the mobile
+    app and sync scripts. Everything is under /api/v1 and needs a logged in
+    session, like the pages.
+
+    GET /api/v1/artefacts               the family's artefacts, newest first
+    GET /api/v1/artefacts/<id>          one artefact, with images and tags
+    GET /api/v1/tags                    tags used in the family
+    GET /api/v1/family/members          the family's members
+
+    Artefact lists are paginated by cursor: pass a response's next_cursor
+    back as ?after= (or prev_cursor as ?before=). They take the same
+    filters as the grid (?filtertags=1&filtertags=2, ?q=words), and
+    ?fields=artefact_id,name,image to return only some fields.
+
+    List responses are encoded and sent one item at a time, so even a big
+    page is never held in memory as one JSON string.
+'''
+
+import json
+
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional
+
+from flask import Blueprint, Response, abort, jsonify, request
+from flask_login import current_user
+from werkzeug.exceptions import HTTPException
+
+from model import ArtefactImage
+from persistence import (
+        get_artefact_detail,
+        get_family,
+        get_family_tags,
+        get_user_artefacts
+)
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# what ?fields= can ask for
+ARTEFACT_FIELDS = ('artefact_id', 'name', 'description', 'owner', 'owner_first_name',
+                   'owner_surname', 'date_stored', 'stored_with', 'stored_with_user',
+                   'stored_at_loc')
+PREVIEW_FIELDS = ARTEFACT_FIELDS + ('updated_at', 'image')
+DETAIL_FIELDS = ARTEFACT_FIELDS + ('location', 'images', 'tags', 'media_pending')
+
+
+@api.before_request
+def require_login():
+    # The pages redirect to the login form, which is no use to a script
+    if not current_user.is_authenticated:
+        return jsonify(error="login required"), 401
+
+
+# by code, or the app's HTML error pages would take precedence
+@api.errorhandler(400)
+@api.errorhandler(404)
+def json_error(e: HTTPException):
+    return jsonify(error=e.description), e.code
+
+
+def to_json(value):
+    ''' default= for json.dumps '''
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"can't encode {type(value).__name__} as JSON")
+
+
+def image_json(image: ArtefactImage) -> Dict:
+    # image URLs are presigned by the time they get here
+    return {'image_id': image.image_id,
+            'description': image.image_description,
+            'url': image.image_url,
+            'thumb_url': image.thumb_url,
+            'medium_url': image.medium_url}
+
+
+def requested_fields(allowed: Iterable[str]) -> Optional[List[str]]:
+    ''' The fields named in ?fields=, or None for all of them '''
+    fields = request.args.get('fields')
+    if not fields:
+        return None
+
+    wanted = [field.strip() for field in fields.split(',') if field.strip()]
+    unknown = set(wanted) - set(allowed)
+    if unknown:
+        abort(400, f"unknown fields: {', '.join(sorted(unknown))}")
+    return wanted
+
+
+def select_fields(obj: Dict, fields: Optional[List[str]]) -> Dict:
+    if fields is None:
+        return obj
+    return {field: obj[field] for field in fields}
+
+
+def preview_json(preview: Dict) -> Dict:
+    ''' A list item, from a row_to_artefact_preview dict '''
+    obj = preview['artefact']._asdict()
+    obj['updated_at'] = preview['updated_at']
+    obj['owner_first_name'] = preview['first_name']
+    obj['owner_surname'] = preview['last_name']
+    obj['image'] = image_json(preview['image']) if preview['image'] is not None else None
+    return obj
+
+
+def stream_list(items: Iterable[Dict], **extra) -> Response:
+    ''' A response of {"items": [...], **extra}, encoded as it's sent '''
+
+    def generate():
+        yield '{"items": ['
+        for i, item in enumerate(items):
+            if i > 0:
+                yield ', '
+            yield json.dumps(item, default=to_json)
+        yield ']'
+        for key, value in extra.items():
+            yield f', {json.dumps(key)}: {json.dumps(value, default=to_json)}'
+        yield '}'
+
+    return Response(generate(), mimetype='application/json')
+
+
+@api.route('/artefacts')
+def artefacts():
+    try:
+        page_size = int(request.args.get('page_size', DEFAULT_PAGE_SIZE))
+        tag_ids = {int(tag_id) for tag_id in request.args.getlist('filtertags')}
+    except ValueError:
+        abort(400, "page_size and filtertags must be integers")
+    page_size = max(1, min(page_size, MAX_PAGE_SIZE))
+
+    try:
+        page = get_user_artefacts(current_user.id, current_user.family_id,
+                                  page_size=page_size,
+                                  after=request.args.get('after'),
+                                  before=request.args.get('before'),
+                                  tag_ids=tag_ids,
+                                  query=request.args.get('q', '').strip() or None)
+    except ValueError:
+        abort(400, "invalid cursor")
+
+    # the items are encoded after this returns, outside the request
+    fields = requested_fields(PREVIEW_FIELDS)
+    items = (select_fields(preview_json(preview), fields) for preview in page.items)
+
+    return stream_list(items, next_cursor=page.next_cursor, prev_cursor=page.prev_cursor)
+
+
+@api.route('/artefacts/<int:artefact_id>')
+def artefact(artefact_id):
+    detail = get_artefact_detail(artefact_id, current_user.family_id)
+    # don't let on that other families' artefacts exist
+    if detail is None or not detail.viewer_has_access:
+        abort(404, "no such artefact")
+
+    obj = detail.artefact._asdict()
+    obj['owner_first_name'] = detail.owner.first_name
+    obj['owner_surname'] = detail.owner.surname
+    obj['location'] = detail.location
+    obj['images'] = [image_json(image) for image in detail.images]
+    obj['tags'] = [tag._asdict() for tag in detail.tags]
+    obj['media_pending'] = detail.media_pending
+
+    return Response(json.dumps(select_fields(obj, requested_fields(DETAIL_FIELDS)),
+                               default=to_json),
+                    mimetype='application/json')
+
+
+@api.route('/tags')
+def tags():
+    return stream_list(tag._asdict() for tag in get_family_tags(current_user.family_id))
+
+
+@api.route('/family/members')
+def family_members():
+    return stream_list(user._asdict() for user in get_family(current_user.family_id))
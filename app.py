@@ -1,11 +1,11 @@
+import hmac
 import sys
 import os
 
-from typing import Dict
+from functools import wraps
 
-from flask import Flask, current_app, request, abort, redirect, render_template, flash, url_for
+from flask import Flask, Response, request, abort, redirect, render_template, flash, url_for, jsonify, make_response, stream_with_context
 
-from flask_sqlalchemy import SQLAlchemy
 from flask_login import (
         LoginManager,
         UserMixin,
@@ -15,42 +15,47 @@ from flask_login import (
         current_user
 )
 
-from flask_bcrypt import check_password_hash, generate_password_hash
-from jinja2 import Template
-
-import psycopg2
-
 from persistence import (
         add_artefact,
-        add_image,
+        add_images,
         create_family,
         edit_artefact_db,
         email_taken,
-        family_user_ids,
         generate_img_filename,
-        get_artefact_images_metadata,
         get_artefacts,
+        get_artefact_detail,
+        get_artefact_images_metadata,
+        get_cover_image_id,
+        get_artefact_version,
+        get_family_revision,
         get_current_user_family,
         get_family,
         get_family_id,
         get_referral_code,
-        remove_artefact,
-        get_user,
         get_tags_by_ids,
-        get_tags_of_artefacts,
-        get_tags_of_each_artefact,
         get_user_artefacts,
+        get_family_tags,
         register_user,
         remove_artefact,
-        upload_image,
-        get_user_loc,
-        get_tags_by_names,
-        insert_tag,
-        pair_tag_to_artefact,
-        edit_user_details
+        upload_images,
+        edit_user_details,
+        tag_artefact,
+        presigned_url_cache,
+        card_cache,
+        get_user_row,
+        user_cache,
+        user_in_family,
+        family_cache
 )
+from api import api
+from conditional import add_validators, not_modified, page_validators
+from export import family_archive
+from jobs import enqueue, get_artefact_job_status
+import metrics
+from passwords import PasswordServiceBusy, check_password, get_hasher, hash_password
+from pool import PoolTimeout, get_pool
 from views import view_artefacts, view_artefact
-from model import Artefact, Credentials, Register, ArtefactImage, Tag
+from model import Artefact, Credentials, Register
 
 app = Flask(__name__, template_folder='views')
 
@@ -73,33 +78,52 @@ else:
     app.config['db_URL'] = db_URL
 
 
-app.config['SQLALCHEMY_DATABASE_URI'] = db_URL
+# Each worker process keeps a pool of this many postgres connections, rather
+# than opening a new one for every query.
+app.config['DB_POOL_SIZE'] = int(os.environ.get("DB_POOL_SIZE", 5))
+app.config['DB_POOL_TIMEOUT'] = float(os.environ.get("DB_POOL_TIMEOUT", 10))
+app.config['DB_POOL_HEALTH_CHECK_AFTER'] = float(
+        os.environ.get("DB_POOL_HEALTH_CHECK_AFTER", 30))
+
 app.config['SECRET_KEY'] = 'hidden'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
-db = SQLAlchemy()
-db.init_app(app)
+# Summarise the database and S3 calls each request made, in an
+# X-Query-Summary response header and/or a log line. Handy for spotting N+1
+# query patterns.
+app.config['QUERY_SUMMARY_HEADER'] = os.environ.get("QUERY_SUMMARY_HEADER") == "1"
+app.config['QUERY_SUMMARY_LOG'] = os.environ.get("QUERY_SUMMARY_LOG") == "1"
+if app.config['QUERY_SUMMARY_LOG']:
+    metrics.enable_query_log()
+
+# Changes with every deploy (given heroku's dyno metadata), so browsers don't
+# keep reusing pages built by old templates.
+app.config['RELEASE'] = os.environ.get("HEROKU_SLUG_COMMIT", "")
+
+# set by gunicorn.conf.py; None when the app isn't run by gunicorn
+app.config['WORKER_CLASS'] = os.environ.get("GUNICORN_WORKER_CLASS")
+
+# /stats and /metrics are only served to requests bearing this token, e.g.
+# `Authorization: Bearer <token>` from the scraper. Unset, they're off.
+app.config['METRICS_TOKEN'] = os.environ.get("METRICS_TOKEN")
 
 login_manager = LoginManager()
 login_manager.init_app(app)
 
+app.register_blueprint(api)
+
+# number of artefacts shown per page of the /artefacts grid
+DEFAULT_PAGE_SIZE = 24
+MAX_PAGE_SIZE = 100
+
 print()
 print("Shell-safe is running!")
 print()
 
 
 # User class to track logging
-class User(UserMixin, db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    email = db.Column(db.String(50), unique=True)
-    first_name = db.Column(db.String(100))
-    surname = db.Column(db.String(100))
-    family_id = db.Column(db.Integer)
-    location = db.Column(db.String(200))
-
-    def __init__(self, db_user, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+class User(UserMixin):
 
+    def __init__(self, db_user):
         self.id = db_user[0]
         self.first_name = db_user[1]
         self.email = db_user[2]
@@ -110,7 +134,20 @@ class User(UserMixin, db.Model):
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    db_user = get_user_row(int(user_id))
+    if db_user is None:
+        return None
+    return User(db_user)
+
+@app.before_request
+def start_request_metrics():
+    metrics.start_request()
+
+@app.after_request
+def finish_request_metrics(response):
+    return metrics.finish_request(response,
+                                  header=app.config['QUERY_SUMMARY_HEADER'],
+                                  log=app.config['QUERY_SUMMARY_LOG'])
 
 # --------------------- #
 # ------ ROUTES ------- #
@@ -133,7 +170,7 @@ def edit_artefact(artefact_id):
 
     try:
         [artefact] = get_artefacts(artefact_id)
-    except ValueError as e:
+    except ValueError:
         flash("Couldn't find that artefact")
         return redirect(url_for('artefacts'))
 
@@ -142,7 +179,9 @@ def edit_artefact(artefact_id):
         if artefact.owner == current_user.id:
 
             family = get_current_user_family()
-            return render_template('edit_artefact.html', artefact=artefact, family=family)
+            images = get_artefact_images_metadata(artefact_id)
+            return render_template('edit_artefact.html', artefact=artefact, family=family,
+                                   images=images, cover_image_id=get_cover_image_id(artefact_id))
         else:
             flash("You are not authorised to edit that artefact")
             return redirect('/artefacts')
@@ -159,7 +198,19 @@ def edit_artefact(artefact_id):
                 print(str(e))
                 return unauthorized()
 
-            edit_artefact_db(changed_artefact)
+            cover_image_id = None
+            if 'cover_image_id' in request.form:
+                try:
+                    cover_image_id = int(request.form['cover_image_id'])
+                except ValueError:
+                    abort(400)
+
+            # saved along with the cover, so a bad one doesn't leave the
+            # edit half done
+            try:
+                edit_artefact_db(changed_artefact, cover_image_id)
+            except ValueError:
+                abort(400)
 
             maybe_add_pics(artefact_id)
             maybe_add_tags(artefact_id)
@@ -174,21 +225,12 @@ def edit_artefact(artefact_id):
 def maybe_add_tags(artefact_id):
     # Puts tags into formatted list
     tags = [tag.strip() for tag in request.form["tags"].split(',')]
+    tags = [tag for tag in tags if tag]
 
     if not tags:
         return
 
-    existing_tags = get_tags_by_names(tags)
-
-    existing_tag_names = [t.name for t in existing_tags]
-    tag_ids = [t.tag_id for t in existing_tags]
-
-    for tag in tags:
-        if tag not in existing_tag_names:
-            tag_ids.append(insert_tag(tag))
-
-    for tag_id in tag_ids:
-        pair_tag_to_artefact(artefact_id, tag_id)
+    tag_artefact(artefact_id, tags)
 
 
 @app.route('/profile')
@@ -223,77 +265,125 @@ def familysettings():
     
     referral_code = get_referral_code(current_user.family_id)
     family = get_family(current_user.family_id)
-    return render_template('family_settings.html', family=family, referral_code=referral_code)
+    return render_template('family_settings.html', family=family, referral_code=referral_code,
+                           can_export=export_available())
+
+def export_available() -> bool:
+    # Built as it's sent, which for a big collection takes far longer than
+    # gunicorn lets a sync worker spend on a request. It'd be killed part
+    # way through, leaving a truncated zip that looks like a finished one.
+    return app.config['WORKER_CLASS'] != 'sync'
+
+@app.route('/family/export')
+@login_required
+def export_family():
+    if not export_available():
+        app.logger.warning("family export refused: needs WEB_WORKER_CLASS=gevent")
+        flash("Downloading everything isn't available right now, sorry")
+        return redirect(url_for('familysettings'))
+
+    family_id = current_user.family_id
+    return Response(stream_with_context(family_archive(family_id)),
+                    mimetype='application/zip',
+                    headers={'Content-Disposition':
+                             f'attachment; filename="shellsafe-family-{family_id}.zip"'})
 
 
 @app.route('/artefacts')
 @login_required
 def artefacts():
-    family_artefacts = get_user_artefacts(current_user.id, current_user.family_id)
-    family_artefact_ids = [p['artefact'].artefact_id for p in family_artefacts]
-    family_tags = get_tags_of_artefacts(family_artefact_ids)
+    try:
+        page_size = int(request.args.get('page_size', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        abort(400)
+    page_size = max(1, min(page_size, MAX_PAGE_SIZE))
 
-    if 'filtertags' in request.args:
-        filtertag_ids = [int(tag_id) for tag_id in request.args.getlist('filtertags')]
-        filtered_tags = get_tags_by_ids(filtertag_ids)
+    try:
+        filtertag_ids = {int(tag_id) for tag_id in request.args.getlist('filtertags')}
+    except ValueError:
+        abort(400)
 
-        artefacts = filter_artefact_previews_by_tags(family_artefacts, filtered_tags)
-        return view_artefacts(artefacts, current_user.id, family_tags, filtered_tags)
-    else:
-        artefacts = family_artefacts
-        return view_artefacts(artefacts, current_user.id, family_tags)
+    query = request.args.get('q', '').strip()
+
+    # the grid only changes when the family's revision does
+    validators = page_validators('artefacts', get_family_revision(current_user.family_id))
+    response = not_modified(validators)
+    if response is not None:
+        return response
+
+    try:
+        page = get_user_artefacts(current_user.id, current_user.family_id,
+                                  page_size=page_size,
+                                  after=request.args.get('after'),
+                                  before=request.args.get('before'),
+                                  tag_ids=filtertag_ids,
+                                  query=query or None)
+    except ValueError:
+        abort(400)
 
+    family_tags = get_family_tags(current_user.family_id)
+    filtered_tags = get_tags_by_ids(list(filtertag_ids)) if filtertag_ids else None
 
-def filter_artefact_previews_by_tags(previews: [Dict], tags: [Tag]) -> [Dict]:
-    artefact_ids = [preview['artefact'].artefact_id for preview in previews]
-    artefact_tags = get_tags_of_each_artefact(artefact_ids)
+    next_url = page_url(after=page.next_cursor) if page.next_cursor else None
+    prev_url = page_url(before=page.prev_cursor) if page.prev_cursor else None
 
-    print('artefact_tags:')
-    print(artefact_tags)
+    return add_validators(make_response(
+            view_artefacts(page.items, current_user.id, family_tags, filtered_tags,
+                           next_url=next_url, prev_url=prev_url, query=query)),
+        validators)
 
-    has_all_tags = []
-    for p in previews:
-        artefact_id = p['artefact'].artefact_id
-        if artefact_id not in artefact_tags:
-            continue
 
-        print(f'artefact_id type: {type(artefact_id)}')
-        print(f'artefact_id: {artefact_id}')
-        print(f'artefact_tags[artefact_id]: {artefact_tags[artefact_id]}')
-        if all(tag in artefact_tags[artefact_id] for tag in tags):
-            has_all_tags.append(p)
+def page_url(**cursor) -> str:
+    ''' URL of another page of the current artefacts listing, keeping any
+        filters and page size the same.
+    '''
+    args = request.args.to_dict(flat=False)
+    args.pop('after', None)
+    args.pop('before', None)
+    args.update(cursor)
+    return url_for('artefacts', **args)
 
-    return has_all_tags
 
 @app.route('/artefact/<int:artefact_id>')
 @login_required
 def artefact(artefact_id):
-    try:
-        [artefact] = get_artefacts(artefact_id)
-    except ValueError as e:
+    validators = None
+    version = get_artefact_version(artefact_id, current_user.family_id)
+    if version is not None:
+        updated_at, viewer_has_access = version
+        if viewer_has_access:
+            validators = page_validators('artefact', artefact_id, updated_at=updated_at)
+            response = not_modified(validators)
+            if response is not None:
+                return response
+
+    detail = get_artefact_detail(artefact_id, current_user.family_id)
+    if detail is None:
         flash("Couldn't find that Artefact!")
         return redirect(url_for('artefacts'))
 
-    if artefact.owner in family_user_ids(current_user.family_id):
-
-        artefact_images = get_artefact_images_metadata(artefact_id)
-
-        owner = get_user(artefact.owner)
-
-        if artefact.stored_with == "user":
-            location = get_user_loc(artefact.stored_with_user)
-
-        else:
-            location = artefact.stored_at_loc
-
-        tags = get_tags_of_artefacts([artefact.artefact_id])
-
-        return view_artefact(artefact, artefact_images, current_user.id, location, owner, tags)
+    if detail.viewer_has_access:
+        return add_validators(make_response(
+                view_artefact(detail.artefact, detail.images, current_user.id,
+                              detail.location, detail.owner, detail.tags,
+                              detail.media_pending)),
+            validators)
 
     else:
         flash("You don't have access to this item")
         return unauthorized()
 
+@app.route('/artefact/<int:artefact_id>/jobs')
+@login_required
+def artefact_jobs(artefact_id):
+    ''' Lets the artefact page check whether its images are still being
+        processed in the background.
+    '''
+    status = get_artefact_job_status(artefact_id, current_user.family_id)
+    if status is None:
+        abort(404)
+    return jsonify(status)
+
 @app.route('/deleteartefact/<int:artefact_id>', methods=['POST'])
 @login_required
 def delete_artefact(artefact_id):
@@ -301,7 +391,7 @@ def delete_artefact(artefact_id):
 
     try:
         [artefact] = get_artefacts(artefact_id)
-    except ValueError as e:
+    except ValueError:
         return "Couldn't find that Artefact!", 400
 
     if artefact.owner == current_user.id:
@@ -337,7 +427,7 @@ def login():
             hash_pw = db_user[3]
 
             # Determines if the password has is correct
-            if check_password_hash(hash_pw.tobytes(), new_user.password):
+            if check_password(hash_pw.tobytes(), new_user.password):
 
                 new_user = User(db_user)
                 login_user(new_user)
@@ -385,7 +475,7 @@ def register():
                                         family_id,
                                         request.form['email'],
                                         request.form['location'],
-                                        generate_password_hash(request.form['pass']))
+                                        hash_password(request.form['pass']))
 
                 register_user(new_register)
 
@@ -442,16 +532,27 @@ def maybe_add_pics(artefact_id: int):
 
         pics = request.files.getlist('pic')
 
+        uploads = []
         for pic in pics:
             if pic.filename != '':
-
                 fname = generate_img_filename(current_user.id, pic)
-                upload_image(pic, fname)
-                artefact_image = ArtefactImage(None, artefact_id, fname, None)  
-                add_image(artefact_image)
+                uploads.append((pic, fname))
             else:
                 print("A file was given, but it was empty")
 
+        uploaded, failed = upload_images(artefact_id, uploads)
+
+        image_ids = add_images(uploaded)
+
+        # making thumbnails is slow, so it's left to the job worker
+        enqueue('derive_image_renditions',
+                [{'image_id': image_id} for image_id in image_ids],
+                artefact_id=artefact_id)
+
+        if failed:
+            flash("Some pictures couldn't be uploaded: " +
+                  ", ".join(pic.filename for (pic, e) in failed))
+
 
 @login_manager.unauthorized_handler
 def unauthorized():
@@ -476,6 +577,48 @@ def bad_request(e):
 def method_not_allowed(e):
     return redirect('/')
 
+@app.errorhandler(PoolTimeout)
+def database_busy(e):
+    return "The server is busy, please try again shortly", 503
+
+@app.errorhandler(PasswordServiceBusy)
+def password_service_busy(e):
+    return ("Lots of people are logging in right now, please try again shortly",
+            503, {'Retry-After': '5'})
+
+
+def component_stats():
+    return {'db_pool': get_pool().stats(),
+            'presigned_urls': presigned_url_cache.stats(),
+            'users': user_cache.stats(),
+            'families': family_cache.stats(),
+            'cards': card_cache.stats(),
+            'passwords': get_hasher().stats()}
+
+def metrics_token_required(view):
+    ''' Keeps operational numbers (pool use, cache hits, request volumes)
+        away from anyone without METRICS_TOKEN. '''
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        token = app.config['METRICS_TOKEN']
+        auth = request.headers.get('Authorization', '')
+        # don't let on that the endpoint exists
+        if not token or not hmac.compare_digest(auth.encode(), f'Bearer {token}'.encode()):
+            abort(404)
+        return view(*args, **kwargs)
+    return wrapper
+
+@app.route('/stats')
+@metrics_token_required
+def stats():
+    return jsonify(component_stats())
+
+@app.route('/metrics')
+@metrics_token_required
+def prometheus_metrics():
+    return Response(metrics.render(component_stats()),
+                    mimetype='text/plain; version=0.0.4')
+
 def create_artefact(artefact_id=None) -> Artefact:
 
     # if we get a KeyError accessing the contents of request.form, flask will
@@ -494,6 +637,9 @@ def create_artefact(artefact_id=None) -> Artefact:
         except ValueError:
             raise ValueError("stored with user wasn't an integer!")
 
+        if not user_in_family(stored_with_user, current_user.family_id):
+            raise ValueError("stored with user isn't in your family")
+
     elif request.form['stored_with'] == 'location':
         stored_at_loc = request.form['stored_at_loc']
         stored_with_user = None
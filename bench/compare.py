@@ -0,0 +1,87 @@
+''' Benchmarks two commits against the same seeded database and prints the
+    difference.
+
+    Each commit is checked out into a temporary git worktree and run.py is
+    run against it, so the working tree is left alone. Any extra arguments
+    are passed on to run.py.
+
+    python bench/compare.py master HEAD -- --concurrency 8 --requests 500
+
+    Note the upload scenario adds artefacts, so the second run sees slightly
+    more data than the first. Leave it out (--scenario ...) for a like for
+    like comparison, or reseed between comparisons.
+'''
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+COLUMNS = (('p50_ms', 'p50 ms'), ('p95_ms', 'p95 ms'), ('p99_ms', 'p99 ms'),
+           ('throughput_rps', 'req/s'), ('queries_per_request', 'queries'))
+
+
+def git(*args) -> str:
+    return subprocess.run(['git', *args], cwd=ROOT, capture_output=True,
+                          text=True, check=True).stdout.strip()
+
+
+def benchmark(rev: str, workdir: str, run_args: [str]) -> dict:
+    checkout = os.path.join(workdir, rev.replace('/', '_'))
+    output = checkout + '.json'
+    git('worktree', 'add', '--detach', checkout, rev)
+    try:
+        # always use this run.py, so both commits are measured the same way
+        subprocess.run([sys.executable, os.path.join(HERE, 'run.py'),
+                        '--app-dir', checkout, '--output', output, *run_args],
+                       check=True)
+        with open(output) as f:
+            return json.load(f)
+    finally:
+        git('worktree', 'remove', '--force', checkout)
+
+
+def change(before, after) -> str:
+    if before is None or after is None:
+        return ''
+    if before == 0:
+        return ''
+    return f'{(after - before) / before * 100:+.0f}%'
+
+
+def fmt(value) -> str:
+    return 'n/a' if value is None else f'{value:.1f}'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('base')
+    parser.add_argument('head')
+    parser.add_argument('run_args', nargs='*', help='passed on to run.py')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        base = benchmark(args.base, workdir, args.run_args)
+        head = benchmark(args.head, workdir, args.run_args)
+
+    print(f'\n{args.base} ({base["commit"]}) -> {args.head} ({head["commit"]})\n')
+    print(f'{"scenario":<20}' + ''.join(f'{title:>26}' for (_, title) in COLUMNS))
+    for scenario, after in head['results'].items():
+        before = base['results'].get(scenario)
+        if before is None:
+            continue
+        cells = (f'{fmt(before[key])} -> {fmt(after[key])} {change(before[key], after[key]):>5}'
+                 for (key, _) in COLUMNS)
+        print(f'{scenario:<20}' + ''.join(f'{cell:>26}' for cell in cells))
+        if before['errors'] or after['errors']:
+            print(f'{"":<20}errors: {before["errors"]} -> {after["errors"]}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,268 @@
+''' Load test for the hot routes.
+
+    Drives the app in-process through Flask's test client, from several
+    threads at once, against the database in DATABASE_URL (fill it with
+    seed.py first). S3 is replaced by moto's in-memory stand-in, so nothing
+    leaves the machine.
+
+    For each scenario it reports p50/p95/p99 latency, throughput, and the
+    average number of database queries per request (from the
+    X-Query-Summary header; n/a for versions of the app without it).
+
+    python bench/run.py --concurrency 8 --requests 500
+    python bench/run.py --scenario artefact --scenario login --output out.json
+
+    --app-dir runs against another checkout of the app, which is how
+    compare.py benchmarks two commits.
+'''
+
+import argparse
+import io
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+from seed import EMAIL_PATTERN, PASSWORD
+
+SCENARIOS = ('artefacts', 'artefacts_filtered', 'search', 'artefact', 'login', 'upload')
+
+
+class BenchData:
+    ''' The seeded users, and for each family its artefacts and tags '''
+
+    def __init__(self, db_URL: str):
+        with psycopg2.connect(db_URL) as conn:
+            cur = conn.cursor()
+            cur.execute('''SELECT email, family_id FROM "user" WHERE email LIKE %s''',
+                        (EMAIL_PATTERN,))
+            self.users = cur.fetchall()
+            if not self.users:
+                sys.exit('no benchmark users found; run bench/seed.py first')
+
+            family_ids = tuple({family_id for (_, family_id) in self.users})
+
+            cur.execute('''SELECT "user".family_id, Artefact.artefact_id
+                           FROM Artefact
+                           INNER JOIN "user" ON "user".id = Artefact.owner
+                           WHERE "user".family_id IN %s''', (family_ids,))
+            self.artefacts = {}
+            for family_id, artefact_id in cur.fetchall():
+                self.artefacts.setdefault(family_id, []).append(artefact_id)
+
+            cur.execute('''SELECT DISTINCT "user".family_id, ArtefactTaggedWith.tag_id
+                           FROM ArtefactTaggedWith
+                           INNER JOIN Artefact USING (artefact_id)
+                           INNER JOIN "user" ON "user".id = Artefact.owner
+                           WHERE "user".family_id IN %s''', (family_ids,))
+            self.tags = {}
+            for family_id, tag_id in cur.fetchall():
+                self.tags.setdefault(family_id, []).append(tag_id)
+        conn.close()
+
+
+def sample_image() -> bytes:
+    try:
+        from PIL import Image
+    except ImportError:
+        return b'not really a jpeg'
+    out = io.BytesIO()
+    Image.new('RGB', (1600, 1200), (120, 160, 90)).save(out, 'JPEG')
+    return out.getvalue()
+
+
+class Client:
+    ''' One simulated user, with their own session '''
+
+    def __init__(self, app, data: BenchData, rng: random.Random):
+        self.app = app
+        self.data = data
+        self.rng = rng
+        self.email, self.family_id = rng.choice(data.users)
+        self.client = app.test_client()
+        response = self.login(self.client)
+        if response.status_code >= 400:
+            raise RuntimeError(f'logging in as {self.email} failed: {response.status_code}')
+
+    def login(self, client):
+        return client.post('/login', data={'email': self.email, 'password': PASSWORD})
+
+    def request(self, scenario: str, image: bytes):
+        if scenario == 'artefacts':
+            return self.client.get('/artefacts')
+
+        elif scenario == 'artefacts_filtered':
+            tags = self.data.tags.get(self.family_id, [])
+            chosen = self.rng.sample(tags, min(2, len(tags)))
+            return self.client.get('/artefacts', query_string=[('filtertags', t) for t in chosen])
+
+        elif scenario == 'search':
+            # seeded artefacts are all called "Heirloom <n>"
+            return self.client.get('/artefacts',
+                                   query_string={'q': f'heirloom {self.rng.randrange(100)}'})
+
+        elif scenario == 'artefact':
+            artefact_id = self.rng.choice(self.data.artefacts[self.family_id])
+            return self.client.get(f'/artefact/{artefact_id}')
+
+        elif scenario == 'login':
+            # a fresh session each time, as a user arriving would have
+            return self.login(self.app.test_client())
+
+        elif scenario == 'upload':
+            return self.client.post('/uploadartefact',
+                                    content_type='multipart/form-data',
+                                    data={'name': 'Benchmark upload',
+                                          'description': 'uploaded by bench/run.py',
+                                          'stored_with': 'location',
+                                          'stored_at_loc': 'The attic',
+                                          'tags': 'bench-0, bench-1, bench-new',
+                                          'pic': (io.BytesIO(image), 'photo.jpg')})
+
+        raise ValueError(scenario)
+
+
+def percentile(ordered: [float], p: float) -> float:
+    if not ordered:
+        return float('nan')
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def run_scenario(app, data, scenario, concurrency, requests, warmup, seed):
+    image = sample_image()
+    clients = [Client(app, data, random.Random(seed + i)) for i in range(concurrency)]
+
+    for i in range(warmup):
+        clients[i % concurrency].request(scenario, image)
+
+    latencies, queries = [], []
+    errors = 0
+    lock = threading.Lock()
+    # spread the requests over the clients, each making its share in turn
+    shares = [requests // concurrency + (1 if i < requests % concurrency else 0)
+              for i in range(concurrency)]
+
+    def work(client, n):
+        nonlocal errors
+        for _ in range(n):
+            start = time.perf_counter()
+            response = client.request(scenario, image)
+            elapsed = time.perf_counter() - start
+
+            summary = re.search(r'db=(\d+)', response.headers.get('X-Query-Summary', ''))
+            with lock:
+                latencies.append(elapsed)
+                if summary:
+                    queries.append(int(summary.group(1)))
+                if response.status_code >= 400:
+                    errors += 1
+
+    wall_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(work, c, n) for (c, n) in zip(clients, shares)]:
+            future.result()
+    wall = time.perf_counter() - wall_start
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'throughput_rps': len(latencies) / wall if wall else float('nan'),
+        'queries_per_request': sum(queries) / len(queries) if queries else None,
+    }
+
+
+def load_app(app_dir: str):
+    ''' Imports the app from app_dir, with S3 stubbed out '''
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'bench')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'bench')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ['QUERY_SUMMARY_HEADER'] = '1'
+
+    try:
+        from moto import mock_aws as mock_s3
+    except ImportError:
+        from moto import mock_s3
+    mock = mock_s3()
+    mock.start()
+
+    sys.path.insert(0, app_dir)
+    import app as shellsafe
+    import boto3
+
+    bucket = getattr(sys.modules.get('persistence'), 'S3_BUCKET', 'shell-safe')
+    boto3.client('s3').create_bucket(Bucket=bucket)
+
+    shellsafe.app.config['TESTING'] = True
+    shellsafe.app.config['QUERY_SUMMARY_HEADER'] = True
+    return shellsafe.app
+
+
+def git_commit(app_dir: str) -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=app_dir,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def print_results(results):
+    print(f'{"scenario":<20}{"reqs":>7}{"errs":>6}{"p50 ms":>10}{"p95 ms":>10}'
+          f'{"p99 ms":>10}{"req/s":>10}{"queries":>9}')
+    for scenario, r in results.items():
+        queries = (f'{r["queries_per_request"]:.1f}'
+                   if r['queries_per_request'] is not None else 'n/a')
+        print(f'{scenario:<20}{r["requests"]:>7}{r["errors"]:>6}{r["p50_ms"]:>10.1f}'
+              f'{r["p95_ms"]:>10.1f}{r["p99_ms"]:>10.1f}{r["throughput_rps"]:>10.1f}'
+              f'{queries:>9}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS,
+                        help='run just these scenarios (default: all)')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=200, help='per scenario')
+    parser.add_argument('--warmup', type=int, default=20, help='untimed requests first')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--app-dir', default=os.path.dirname(HERE))
+    parser.add_argument('--output', help='also write the results here as JSON')
+    args = parser.parse_args()
+
+    db_URL = os.environ.get('DATABASE_URL')
+    if db_URL is None:
+        sys.exit('DATABASE_URL not set')
+
+    data = BenchData(db_URL)
+    app = load_app(os.path.abspath(args.app_dir))
+
+    results = {}
+    for scenario in args.scenario or SCENARIOS:
+        results[scenario] = run_scenario(app, data, scenario, args.concurrency,
+                                         args.requests, args.warmup, args.seed)
+
+    print_results(results)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'commit': git_commit(args.app_dir),
+                       'concurrency': args.concurrency,
+                       'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
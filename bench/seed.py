@@ -0,0 +1,160 @@
+''' Fills the database in DATABASE_URL with synthetic families for
+    benchmarking. The schema must already be in place.
+
+    Every user it makes has an email like bench-3-7@example.com (family 3,
+    user 7) and the password in PASSWORD, which is what run.py logs in with.
+    Images point at S3 keys that don't exist; run.py stubs S3 out anyway.
+
+    python bench/seed.py --families 10 --users 4 --artefacts 250 --images 3
+'''
+
+import argparse
+import os
+import random
+import sys
+
+from datetime import datetime, timedelta
+
+import bcrypt
+import psycopg2
+import psycopg2.extras
+
+PASSWORD = 'benchmark'
+EMAIL_PATTERN = 'bench-%@example.com'
+
+
+def clean(cur):
+    ''' Removes everything a previous seeding made '''
+    cur.execute('''SELECT id, family_id FROM "user" WHERE email LIKE %s''', (EMAIL_PATTERN,))
+    rows = cur.fetchall()
+    if not rows:
+        return
+
+    user_ids = tuple(row[0] for row in rows)
+    family_ids = tuple({row[1] for row in rows})
+
+    cur.execute('''SELECT artefact_id FROM Artefact WHERE owner IN %s''', (user_ids,))
+    artefact_ids = tuple(row[0] for row in cur.fetchall())
+    if artefact_ids:
+        cur.execute('DELETE FROM ArtefactTaggedWith WHERE artefact_id IN %s', (artefact_ids,))
+        cur.execute('DELETE FROM ArtefactImage WHERE artefact_id IN %s', (artefact_ids,))
+        cur.execute('DELETE FROM Artefact WHERE artefact_id IN %s', (artefact_ids,))
+
+    cur.execute('DELETE FROM "user" WHERE id IN %s', (user_ids,))
+    cur.execute('DELETE FROM Family WHERE family_id IN %s', (family_ids,))
+    cur.execute('''DELETE FROM Tag
+                   WHERE name LIKE 'bench-%%'
+                     AND tag_id NOT IN (SELECT tag_id FROM ArtefactTaggedWith)''')
+
+
+def insert(cur, sql, rows, template=None) -> [int]:
+    ''' Multi-row insert returning the first column of each inserted row '''
+    if not rows:
+        return []
+    result = psycopg2.extras.execute_values(cur, sql, rows, template=template,
+                                            page_size=1000, fetch=True)
+    return [row[0] for row in result]
+
+
+def seed(cur, args, rng: random.Random):
+    pw_hash = psycopg2.Binary(bcrypt.hashpw(PASSWORD.encode('utf-8'),
+                                            bcrypt.gensalt(args.bcrypt_rounds)))
+
+    # with --keep, the tags from last time are still there
+    cur.execute('''SELECT tag_id, name FROM Tag WHERE name LIKE 'bench-%%' ''')
+    existing = dict((name, tag_id) for (tag_id, name) in cur.fetchall())
+    wanted = [f'bench-{i}' for i in range(args.tags)]
+    tag_ids = ([existing[name] for name in wanted if name in existing] +
+               insert(cur, 'INSERT INTO Tag (name) VALUES %s RETURNING tag_id',
+                      [(name,) for name in wanted if name not in existing]))
+
+    now = datetime.utcnow()
+    for f in range(args.families):
+        [family_id] = insert(cur, '''INSERT INTO Family (name, referral_code)
+                                     VALUES %s RETURNING family_id''',
+                             [(f'Bench{f}', f'BENCH{f}{rng.randrange(10**12)}')])
+
+        user_ids = insert(cur, '''INSERT INTO "user"
+                                  (first_name, surname, email, password, location, family_id)
+                                  VALUES %s RETURNING id''',
+                          [(f'User{u}', f'Bench{f}', f'bench-{f}-{u}@example.com',
+                            pw_hash, f'House {u}', family_id)
+                           for u in range(args.users)])
+
+        artefacts = []
+        for owner in user_ids:
+            for a in range(args.artefacts):
+                with_user = rng.random() < 0.5
+                artefacts.append((owner,
+                                  f'Heirloom {a}',
+                                  f'Synthetic artefact {a} of user {owner}. ' * 3,
+                                  now - timedelta(minutes=rng.randrange(5 * 365 * 24 * 60)),
+                                  'user' if with_user else 'location',
+                                  rng.choice(user_ids) if with_user else None,
+                                  None if with_user else 'The attic'))
+
+        artefact_ids = insert(cur, '''INSERT INTO Artefact
+                                      (owner, name, description, date_stored,
+                                       stored_with, stored_with_user, stored_at_loc)
+                                      VALUES %s RETURNING artefact_id''', artefacts)
+
+        images = [(artefact_id, f'bench/{artefact_id}-{i}.jpg', None,
+                   f'bench/{artefact_id}-{i}.thumb.jpg', f'bench/{artefact_id}-{i}.medium.jpg')
+                  for artefact_id in artefact_ids
+                  for i in range(args.images)]
+        image_ids = insert(cur, '''INSERT INTO ArtefactImage
+                                   (artefact_id, image_url, image_description,
+                                    thumb_url, medium_url)
+                                   VALUES %s RETURNING image_id''', images)
+        if image_ids:
+            cur.execute('''UPDATE Artefact
+                           SET cover_image_id = (
+                               SELECT MIN(image_id) FROM ArtefactImage
+                               WHERE ArtefactImage.artefact_id = Artefact.artefact_id)
+                           WHERE artefact_id IN %s''', (tuple(artefact_ids),))
+
+        per_artefact = min(args.tags_per_artefact, len(tag_ids))
+        taggings = [(artefact_id, tag_id)
+                    for artefact_id in artefact_ids
+                    for tag_id in rng.sample(tag_ids, per_artefact)]
+        insert(cur, '''INSERT INTO ArtefactTaggedWith (artefact_id, tag_id)
+                       VALUES %s RETURNING artefact_id''', taggings)
+        if artefact_ids:
+            cur.execute('''UPDATE Artefact
+                           SET search_vector = artefact_search_vector(artefact_id)
+                           WHERE artefact_id IN %s''', (tuple(artefact_ids),))
+
+        print(f'family {f}: {len(user_ids)} users, {len(artefact_ids)} artefacts, '
+              f'{len(images)} images, {len(taggings)} taggings')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--families', type=int, default=5)
+    parser.add_argument('--users', type=int, default=4, help='users per family')
+    parser.add_argument('--artefacts', type=int, default=100, help='artefacts per user')
+    parser.add_argument('--images', type=int, default=2, help='images per artefact')
+    parser.add_argument('--tags', type=int, default=50, help='distinct tags in total')
+    parser.add_argument('--tags-per-artefact', type=int, default=3)
+    parser.add_argument('--bcrypt-rounds', type=int, default=12,
+                        help='cost of the users\' password hashes')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--keep', action='store_true',
+                        help="don't remove earlier benchmark data first")
+    args = parser.parse_args()
+
+    db_URL = os.environ.get('DATABASE_URL')
+    if db_URL is None:
+        sys.exit('DATABASE_URL not set')
+
+    with psycopg2.connect(db_URL) as conn:
+        cur = conn.cursor()
+        if not args.keep:
+            clean(cur)
+        seed(cur, args, random.Random(args.seed))
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
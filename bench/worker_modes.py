@@ -0,0 +1,110 @@
+''' Compares throughput of the app under sync and gevent gunicorn workers.
+
+    Starts gunicorn once per worker class against the database in
+    DATABASE_URL, logs in as an existing user, then has many clients fetch
+    the given routes as fast as they can for a while. Prints requests per
+    second for each mode.
+
+    python bench/worker_modes.py --email me@example.com --password hunter2 \
+        --route /artefacts --route /artefact/1
+'''
+
+import argparse
+import http.cookiejar
+import os
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def start_gunicorn(worker_class: str, port: int, workers: int) -> subprocess.Popen:
+    env = dict(os.environ,
+               PORT=str(port),
+               WEB_WORKER_CLASS=worker_class,
+               WEB_CONCURRENCY=str(workers))
+    proc = subprocess.Popen(['gunicorn', 'app:app', '-c', 'gunicorn.conf.py'],
+                            cwd=ROOT, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    # wait for it to come up
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{port}/login', timeout=1)
+            return proc
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.2)
+
+    proc.kill()
+    sys.exit(f"gunicorn ({worker_class}) didn't start")
+
+
+def login(base: str, email: str, password: str) -> urllib.request.OpenerDirector:
+    opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+    data = urllib.parse.urlencode({'email': email, 'password': password}).encode()
+    opener.open(base + '/login', data=data)
+    return opener
+
+
+def hammer(base: str, opener, routes: [str], clients: int, duration: float):
+    ''' Returns (requests completed, errors) '''
+    stop = time.monotonic() + duration
+    counts = [0] * clients
+    errors = [0] * clients
+
+    def client(i):
+        while time.monotonic() < stop:
+            route = routes[counts[i] % len(routes)]
+            try:
+                opener.open(base + route, timeout=30).read()
+                counts[i] += 1
+            except (urllib.error.URLError, ConnectionError):
+                errors[i] += 1
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    return sum(counts), sum(errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--email', required=True)
+    parser.add_argument('--password', required=True)
+    parser.add_argument('--route', action='append', required=True)
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--modes', default='sync,gevent')
+    args = parser.parse_args()
+
+    base = f'http://127.0.0.1:{args.port}'
+
+    for mode in args.modes.split(','):
+        proc = start_gunicorn(mode, args.port, args.workers)
+        try:
+            opener = login(base, args.email, args.password)
+            done, errors = hammer(base, opener, args.route, args.clients, args.duration)
+        finally:
+            proc.terminate()
+            proc.wait()
+
+        print(f'{mode:>8}: {done / args.duration:8.1f} req/s '
+              f'({done} requests, {errors} errors, {args.clients} clients, '
+              f'{args.workers} workers)')
+
+
+if __name__ == '__main__':
+    main()
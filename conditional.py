@@ -0,0 +1,100 @@
+''' Conditional GETs for pages that are expensive to build.
+
+    A page's validators come from cheap version stamps (an artefact's
+    updated_at, a family's revision) and who is looking, so a route can
+    answer If-None-Match / If-Modified-Since with 304 Not Modified before
+    loading or rendering anything.
+
+    Pages embed presigned S3 URLs, which expire. So the validators also
+    change every PERIOD seconds, a quarter of the URLs' lifetime, and a
+    browser never reuses a page whose URLs have run out: they're signed at
+    most half their lifetime before the page is built (see
+    presigned_url_cache), and the page is reused for at most PERIOD after.
+'''
+
+import hashlib
+import time
+
+from collections import namedtuple
+from datetime import datetime, timezone
+from typing import Optional
+
+from flask import Response, current_app, request, session
+from flask_login import current_user
+
+from persistence import PRESIGNED_URL_EXPIRATION
+
+PERIOD = PRESIGNED_URL_EXPIRATION // 4
+
+Validators = namedtuple("Validators", ("etag", "last_modified"))
+
+
+def page_validators(*version, updated_at: datetime = None) -> Optional[Validators]:
+    ''' Validators for the current user's view of a page whose content is
+        determined by `version`, and by updated_at if given.
+
+        Returns None if the page shouldn't be cached at all, which is when
+        it's about to show flashed messages: they mustn't be shown twice.
+    '''
+    if '_flashes' in session:
+        return None
+
+    now = time.time()
+    period_start = int(now - now % PERIOD)
+
+    # the navbar shows the user's name
+    viewer = (current_user.id, current_user.first_name, current_user.surname)
+    key = repr((current_app.config.get('RELEASE'), period_start, viewer, updated_at)
+               + version)
+    etag = hashlib.sha1(key.encode()).hexdigest()
+
+    last_modified = None
+    if updated_at is not None:
+        last_modified = max(utc(updated_at), datetime.utcfromtimestamp(period_start))
+
+    return Validators(etag, last_modified)
+
+
+def not_modified(validators: Optional[Validators]) -> Optional[Response]:
+    ''' A 304 response if the client's copy of the page is still current,
+        otherwise None, meaning the page has to be built.
+    '''
+    if validators is None:
+        return None
+
+    # If-None-Match wins when both are sent
+    if request.if_none_match:
+        current = request.if_none_match.contains_weak(validators.etag)
+    elif request.if_modified_since and validators.last_modified:
+        # HTTP dates only go down to the second
+        current = (validators.last_modified.replace(microsecond=0)
+                   <= utc(request.if_modified_since))
+    else:
+        current = False
+
+    if not current:
+        return None
+    return add_validators(Response(status=304), validators)
+
+
+def add_validators(response: Response, validators: Optional[Validators]) -> Response:
+    if validators is None:
+        return response
+
+    # weak, because a page is rebuilt with freshly signed URLs
+    response.set_etag(validators.etag, weak=True)
+    if validators.last_modified is not None:
+        response.last_modified = validators.last_modified
+
+    # only this user's browser may keep it, and must check with us first
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.vary.add('Cookie')
+    return response
+
+
+def utc(dt: datetime) -> datetime:
+    ''' dt as a naive UTC datetime, as werkzeug's date headers are '''
+    if dt.tzinfo is None:
+        return dt
+    return dt.astimezone(timezone.utc).replace(tzinfo=None)
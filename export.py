@@ -0,0 +1,182 @@
+''' Streams a family's whole collection as a zip: every original image, and
+    a manifest.json describing the artefacts (names, descriptions, owners,
+    where they're kept, tags, and which files are their images).
+
+    The zip is written entry by entry into a buffer that's emptied into the
+    response after every write, so nothing is held in memory beyond a chunk
+    of the image being copied, and nothing goes to disk. Images are fetched
+    from S3 a few at a time ahead of the one being written, so their
+    latencies overlap.
+
+    The database is read a page at a time between entries, so no connection
+    or transaction is held open while waiting on S3 or the client.
+
+    A big export takes a long time to send, longer than gunicorn allows a
+    sync worker, so the route only serves it under gevent workers (see
+    gunicorn.conf.py).
+'''
+
+import json
+import logging
+import os
+import zipfile
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, Iterator
+
+from botocore.exceptions import ClientError
+
+from model import ArtefactDetail, ArtefactImage
+from persistence import (
+        S3_BUCKET,
+        get_s3_client,
+        iter_artefact_details,
+        iter_family_images
+)
+
+# how many images are being fetched from S3 at once, ahead of the one being
+# written. Each holds an open connection, so keep it under the S3 client's
+# connection pool size (10).
+EXPORT_FETCH_WINDOW = int(os.environ.get("EXPORT_FETCH_WINDOW", 4))
+
+# bytes of an image copied into the zip at a time
+EXPORT_CHUNK_SIZE = 256 * 1024
+
+
+class ChunkWriter:
+    ''' A write-only, unseekable file that keeps what's written until it's
+        drained. zipfile copes with not being able to seek by writing a
+        data descriptor after each entry.
+    '''
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def image_path(image: ArtefactImage) -> str:
+    ''' Where an image goes in the zip '''
+    _, extension = os.path.splitext(image.image_url)
+    return f'images/{image.artefact_id}/{image.image_id}{extension.lower()}'
+
+
+def fetch_image(image: ArtefactImage) -> Dict:
+    ''' Starts downloading the original. The body is read as it's written. '''
+    return get_s3_client().get_object(Bucket=S3_BUCKET, Key=image.image_url)
+
+
+def artefact_manifest(detail: ArtefactDetail, missing: Dict[int, str]) -> Dict:
+    artefact = detail.artefact
+    return {
+        'artefact_id': artefact.artefact_id,
+        'name': artefact.name,
+        'description': artefact.description,
+        'date_stored': artefact.date_stored.isoformat() if artefact.date_stored else None,
+        'owner': detail.owner._asdict(),
+        'stored_with': artefact.stored_with,
+        'stored_with_user': artefact.stored_with_user,
+        'location': detail.location,
+        'tags': [tag.name for tag in detail.tags],
+        'images': [{'file': image_path(image),
+                    'description': image.image_description,
+                    'missing': missing.get(image.image_id)}
+                   for image in detail.images],
+    }
+
+
+def family_archive(family_id) -> Iterator[bytes]:
+    ''' Yields the zip of the family's collection, piece by piece. Needs an
+        app context throughout, for the database.
+    '''
+    out = ChunkWriter()
+    # image id -> why it couldn't be included, for the manifest
+    missing = {}
+
+    with zipfile.ZipFile(out, mode='w', allowZip64=True) as archive:
+
+        # The images go first, so the manifest can say which (if any)
+        # couldn't be fetched.
+        with ThreadPoolExecutor(max_workers=EXPORT_FETCH_WINDOW) as executor:
+            images = iter_family_images(family_id)
+            fetching = deque()
+
+            def fetch_ahead():
+                while len(fetching) < EXPORT_FETCH_WINDOW:
+                    image = next(images, None)
+                    if image is None:
+                        return
+                    fetching.append((image, executor.submit(fetch_image, image)))
+
+            try:
+                fetch_ahead()
+                while fetching:
+                    image, future = fetching.popleft()
+                    fetch_ahead()
+
+                    try:
+                        obj = future.result()
+                    except ClientError as e:
+                        logging.warning(f"export: couldn't fetch {image.image_url}: {e}")
+                        missing[image.image_id] = e.response.get('Error', {}).get('Code', 'error')
+                        continue
+
+                    info = zipfile.ZipInfo(image_path(image),
+                                           date_time=zip_time(obj.get('LastModified')))
+                    # already compressed, as images are
+                    info.compress_type = zipfile.ZIP_STORED
+                    # known up front, so zipfile knows whether it needs zip64
+                    info.file_size = obj['ContentLength']
+
+                    body = obj['Body']
+                    try:
+                        with archive.open(info, mode='w') as entry:
+                            for chunk in iter(lambda: body.read(EXPORT_CHUNK_SIZE), b''):
+                                entry.write(chunk)
+                                yield out.drain()
+                    finally:
+                        body.close()
+                    yield out.drain()
+
+            finally:
+                # if the download was abandoned, don't leave connections open
+                images.close()
+                for _, future in fetching:
+                    # those already under way have to finish to be closed
+                    if not future.cancel() and future.exception() is None:
+                        future.result()['Body'].close()
+
+        manifest_info = zipfile.ZipInfo('manifest.json', date_time=zip_time(datetime.utcnow()))
+        manifest_info.compress_type = zipfile.ZIP_DEFLATED
+        with archive.open(manifest_info, mode='w') as manifest:
+            header = {'family_id': family_id,
+                      'exported_at': datetime.utcnow().isoformat() + 'Z'}
+            manifest.write(json.dumps(header)[:-1].encode() + b', "artefacts": [')
+            for i, detail in enumerate(iter_artefact_details(family_id)):
+                if i > 0:
+                    manifest.write(b', ')
+                manifest.write(json.dumps(artefact_manifest(detail, missing)).encode())
+                yield out.drain()
+            manifest.write(b']}')
+
+    # the central directory, written when the archive closes
+    yield out.drain()
+
+
+def zip_time(dt: datetime):
+    ''' A datetime as a zip entry's timestamp, which can't predate 1980 '''
+    if dt is None or dt.year < 1980:
+        return (1980, 1, 1, 0, 0, 0)
+    return dt.timetuple()[:6]
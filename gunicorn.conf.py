@@ -0,0 +1,43 @@
+''' gunicorn settings, read through `-c gunicorn.conf.py` in the Procfile.
+
+    By default each worker handles one request at a time (sync workers), so
+    a dyno can only serve as many requests at once as it has workers, with
+    most of their time spent waiting on postgres and S3.
+
+    Set WEB_WORKER_CLASS=gevent to run each worker as an event loop that
+    serves up to WEB_WORKER_CONNECTIONS requests concurrently, switching
+    between them whenever one waits on the network. With that many requests
+    in flight, DB_POOL_SIZE will usually want raising too.
+
+    Logins are kept from taking every worker (see passwords.py). Sync
+    workers hash inline, but at most PASSWORD_SYNC_SLOTS of them at once
+    (half the workers by default), and the rest answer 503 to logins beyond
+    that. gevent workers hand hashing to threads, with at most
+    PASSWORD_QUEUE_LIMIT logins each in flight.
+'''
+
+import os
+
+bind = '0.0.0.0:' + os.environ.get('PORT', '8000')
+
+worker_class = os.environ.get('WEB_WORKER_CLASS', 'sync')
+
+# A sync worker busy with one request for longer than gunicorn's timeout is
+# killed, cutting the response short, so the app needs to know which it is
+# running under to refuse long streams like the family export. gevent
+# workers keep checking in while they stream.
+raw_env = [f'GUNICORN_WORKER_CLASS={worker_class}']
+
+# heroku sets WEB_CONCURRENCY to suit the dyno size
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+
+worker_connections = int(os.environ.get('WEB_WORKER_CONNECTIONS', 100))
+
+
+def post_fork(server, worker):
+    if worker_class == 'gevent':
+        # gunicorn patches the standard library for us, which covers boto3,
+        # but psycopg2 talks to postgres from C and needs to be told to wait
+        # for the network cooperatively.
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
@@ -0,0 +1,206 @@
+''' A small job queue kept in postgres, for work that shouldn't hold up a
+    request (image processing, mostly).
+
+    The web app enqueues jobs; `python worker.py` (the worker process in the
+    Procfile) claims and runs them. Workers claim jobs with
+    SELECT ... FOR UPDATE SKIP LOCKED, so any number of them can share the
+    queue without handing the same job out twice. A claimed job is hidden
+    from other workers for a visibility timeout; if its worker dies, the job
+    reappears once that runs out. Failed jobs are retried with backoff, up to
+    a limit.
+'''
+
+import json
+import logging
+import time
+import traceback
+
+from collections import namedtuple
+from typing import Dict, Optional
+
+import psycopg2.extras
+
+from persistence import derive_image_renditions, touch_artefacts
+from pool import db_conn
+
+
+Job = namedtuple("Job", ("job_id", "kind", "payload", "artefact_id", "attempts", "max_attempts"))
+
+# kind -> function taking the job's payload as keyword arguments
+HANDLERS = {
+    'derive_image_renditions': derive_image_renditions,
+}
+
+# how long a claimed job stays hidden from other workers
+VISIBILITY_TIMEOUT = 300
+# seconds to wait before retrying a failed job; doubles with each attempt
+RETRY_DELAY = 10
+# how long an idle worker sleeps before looking for new jobs
+POLL_INTERVAL = 2
+# finished jobs are kept this long, so pages polling them can see they're done
+KEEP_DONE_FOR = 24 * 60 * 60
+
+
+def enqueue(kind: str, payloads: [Dict], artefact_id: int = None):
+    ''' Queues one job of the given kind for each payload '''
+
+    if kind not in HANDLERS:
+        raise ValueError(f"unknown job kind: {kind}")
+    if len(payloads) == 0:
+        return
+
+    with db_conn() as conn:
+        cur = conn.cursor()
+        psycopg2.extras.execute_values(
+                cur,
+                '''INSERT INTO Job (kind, payload, artefact_id) VALUES %s''',
+                [(kind, json.dumps(payload), artefact_id) for payload in payloads])
+        # its page now says it's being processed
+        if artefact_id is not None:
+            touch_artefacts(cur, [artefact_id])
+
+
+def claim_job(visibility_timeout=VISIBILITY_TIMEOUT) -> Optional[Job]:
+    ''' Takes the oldest job that's ready to run, or one whose worker has
+        gone quiet for longer than the visibility timeout. Returns None if
+        there's nothing to do.
+    '''
+
+    sql = '''
+    UPDATE Job
+    SET status = 'running',
+        attempts = attempts + 1,
+        locked_until = now() + %(timeout)s * interval '1 second',
+        updated_at = now()
+    WHERE job_id = (
+        SELECT job_id FROM Job
+        WHERE attempts < max_attempts
+          AND ((status = 'queued' AND run_after <= now())
+               OR (status = 'running' AND locked_until < now()))
+        ORDER BY run_after
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED)
+    RETURNING job_id, kind, payload, artefact_id, attempts, max_attempts'''
+
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(sql, {'timeout': visibility_timeout})
+        row = cur.fetchone()
+
+    return Job(*row) if row is not None else None
+
+
+def complete_job(job: Job):
+    # The attempts check stops us marking a job done if it timed out and
+    # another worker has since claimed it.
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute('''UPDATE Job
+                       SET status = 'done', locked_until = NULL, updated_at = now()
+                       WHERE job_id = %(job_id)s AND attempts = %(attempts)s''',
+                    job._asdict())
+        if job.artefact_id is not None and cur.rowcount > 0:
+            touch_artefacts(cur, [job.artefact_id])
+
+
+def fail_job(job: Job, error: str):
+    ''' Puts the job back on the queue to retry later, or marks it failed if
+        it's out of attempts.
+    '''
+    inputs = job._asdict()
+    inputs['error'] = error
+    inputs['delay'] = RETRY_DELAY * 2 ** (job.attempts - 1)
+
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute('''UPDATE Job
+                       SET status = CASE WHEN attempts >= max_attempts
+                                         THEN 'failed' ELSE 'queued' END,
+                           run_after = now() + %(delay)s * interval '1 second',
+                           locked_until = NULL,
+                           last_error = %(error)s,
+                           updated_at = now()
+                       WHERE job_id = %(job_id)s AND attempts = %(attempts)s''',
+                    inputs)
+        if job.artefact_id is not None and cur.rowcount > 0:
+            touch_artefacts(cur, [job.artefact_id])
+
+
+def tidy_jobs():
+    ''' Gives up on jobs whose last attempt timed out, and clears out old
+        finished ones.
+    '''
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute('''UPDATE Job
+                       SET status = 'failed',
+                           last_error = 'timed out',
+                           locked_until = NULL,
+                           updated_at = now()
+                       WHERE status = 'running'
+                         AND locked_until < now()
+                         AND attempts >= max_attempts
+                       RETURNING artefact_id''')
+        artefact_ids = {artefact_id for (artefact_id,) in cur.fetchall()
+                        if artefact_id is not None}
+        if artefact_ids:
+            touch_artefacts(cur, artefact_ids)
+        cur.execute('''DELETE FROM Job
+                       WHERE status = 'done'
+                         AND updated_at < now() - %(age)s * interval '1 second' ''',
+                    {'age': KEEP_DONE_FOR})
+
+
+def get_artefact_job_status(artefact_id: int, viewer_family_id) -> Optional[Dict]:
+    ''' Counts the artefact's jobs by status, for pages waiting on them.
+        Returns None if the artefact doesn't exist or the viewer's family
+        can't see it.
+    '''
+
+    sql = '''
+    SELECT Job.status, COUNT(Job.job_id)
+    FROM Artefact
+    INNER JOIN "user"
+    ON "user".id = Artefact.owner
+    LEFT JOIN Job
+    ON Job.artefact_id = Artefact.artefact_id
+    WHERE Artefact.artefact_id = %(artefact_id)s
+      AND "user".family_id = %(family_id)s
+    GROUP BY Job.status'''
+
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(sql, {'artefact_id': artefact_id, 'family_id': viewer_family_id})
+        rows = cur.fetchall()
+
+    if not rows:
+        return None
+
+    counts = {'queued': 0, 'running': 0, 'done': 0, 'failed': 0}
+    counts.update((status, n) for (status, n) in rows if status is not None)
+    counts['pending'] = counts['queued'] + counts['running'] > 0
+    return counts
+
+
+def run_job(job: Job):
+    try:
+        HANDLERS[job.kind](**job.payload)
+    except Exception:
+        logging.exception(f"job {job.job_id} ({job.kind}) failed")
+        fail_job(job, traceback.format_exc())
+    else:
+        complete_job(job)
+
+
+def run_worker(poll_interval=POLL_INTERVAL):
+    ''' Runs jobs until killed. Needs an app context, for the database URL. '''
+
+    logging.info("job worker started")
+    while True:
+        job = claim_job()
+        if job is None:
+            tidy_jobs()
+            time.sleep(poll_interval)
+            continue
+
+        run_job(job)
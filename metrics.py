@@ -0,0 +1,265 @@
+''' Counts and timings of the database and S3 calls each route makes, served
+    in Prometheus' text format from /metrics.
+
+    Database queries are timed by the cursors the connection pool hands
+    out, and S3 requests by hooks on the shared S3 client, so nothing in
+    persistence.py has to remember to record them. Calls made outside a
+    request (the upload threads, the job worker) are labelled
+    route="background".
+
+    Each worker process keeps its own numbers, like every other per-worker
+    statistic we have.
+'''
+
+import logging
+import threading
+import time
+
+from typing import Dict, Tuple
+
+from flask import g, has_request_context, request
+import psycopg2.extensions
+
+
+# where finish_request's summary lines go, when asked for. See
+# enable_query_log.
+query_log = logging.getLogger('shellsafe.queries')
+
+# upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+# upper bounds of the queries-per-request histogram buckets
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+
+class Counter:
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels: Tuple[Tuple[str, str], ...], amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> [str]:
+        lines = [f'# HELP {self.name} {self.help}',
+                 f'# TYPE {self.name} counter']
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{format_labels(labels)} {value}')
+        return lines
+
+
+class Histogram:
+
+    def __init__(self, name: str, help: str, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        # labels -> [count in each bucket, ..., count, sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels: Tuple[Tuple[str, str], ...], value: float):
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * len(self.buckets) + [0, 0.0]
+
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    def render(self) -> [str]:
+        lines = [f'# HELP {self.name} {self.help}',
+                 f'# TYPE {self.name} histogram']
+        with self._lock:
+            for labels, counts in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, counts):
+                    bucket_labels = labels + (('le', str(bound)),)
+                    lines.append(f'{self.name}_bucket{format_labels(bucket_labels)} {count}')
+                inf_labels = labels + (('le', '+Inf'),)
+                lines.append(f'{self.name}_bucket{format_labels(inf_labels)} {counts[-2]}')
+                lines.append(f'{self.name}_count{format_labels(labels)} {counts[-2]}')
+                lines.append(f'{self.name}_sum{format_labels(labels)} {counts[-1]}')
+        return lines
+
+
+def format_labels(labels) -> str:
+    if not labels:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for (_, value) in labels)
+    return '{' + ','.join(f'{name}="{value}"'
+                          for ((name, _), value) in zip(labels, escaped)) + '}'
+
+
+request_seconds = Histogram('shellsafe_request_seconds',
+                            'Time taken to handle a request')
+db_query_seconds = Histogram('shellsafe_db_query_seconds',
+                             'Time taken by each database query')
+db_rows = Counter('shellsafe_db_rows_total',
+                  'Rows returned or affected by database queries')
+db_queries_per_request = Histogram('shellsafe_db_queries_per_request',
+                                   'Database queries made while handling one request',
+                                   buckets=COUNT_BUCKETS)
+s3_request_seconds = Histogram('shellsafe_s3_request_seconds',
+                               'Time taken by each S3 call')
+
+ALL_METRICS = (request_seconds, db_query_seconds, db_rows,
+               db_queries_per_request, s3_request_seconds)
+
+
+def current_route() -> str:
+    if not has_request_context():
+        return 'background'
+    if request.url_rule is None:
+        return 'none'
+    return request.url_rule.rule
+
+
+def _request_totals():
+    ''' This request's running totals, or None outside a request '''
+    if not has_request_context():
+        return None
+    return g.setdefault('query_totals', {'db': [0, 0.0, 0], 's3': [0, 0.0]})
+
+
+def record_db_query(seconds: float, rows: int):
+    route = current_route()
+    db_query_seconds.observe((('route', route),), seconds)
+    if rows > 0:
+        db_rows.inc((('route', route),), rows)
+
+    totals = _request_totals()
+    if totals is not None:
+        totals['db'][0] += 1
+        totals['db'][1] += seconds
+        totals['db'][2] += max(rows, 0)
+
+
+def record_s3_call(operation: str, seconds: float):
+    s3_request_seconds.observe((('route', current_route()), ('operation', operation)),
+                               seconds)
+
+    totals = _request_totals()
+    if totals is not None:
+        totals['s3'][0] += 1
+        totals['s3'][1] += seconds
+
+
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    ''' A cursor that records how long each query takes '''
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            record_db_query(time.perf_counter() - start, self.rowcount)
+
+    def executemany(self, query, vars_list):
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            record_db_query(time.perf_counter() - start, self.rowcount)
+
+
+def instrument_s3_client(client):
+    ''' Hooks the client's requests so they are timed '''
+
+    def before_call(context, **kwargs):
+        context['metrics_start'] = time.perf_counter()
+
+    def after_call(model, context, **kwargs):
+        start = context.get('metrics_start')
+        if start is not None:
+            record_s3_call(model.name, time.perf_counter() - start)
+
+    client.meta.events.register('before-call.s3', before_call)
+    client.meta.events.register('after-call.s3', after_call)
+    return client
+
+
+def start_request():
+    g.request_start = time.perf_counter()
+
+
+def finish_request(response, header: bool, log: bool):
+    ''' Records the request's timing and query count, and optionally
+        summarises its queries in an X-Query-Summary header and/or a log
+        line. Meant for after_request.
+    '''
+    start = g.get('request_start')
+    if start is None:
+        return response
+
+    route = current_route()
+    elapsed = time.perf_counter() - start
+    totals = _request_totals()
+    (db_count, db_time, rows), (s3_count, s3_time) = totals['db'], totals['s3']
+
+    request_seconds.observe((('route', route),
+                             ('method', request.method),
+                             ('status', str(response.status_code))), elapsed)
+    db_queries_per_request.observe((('route', route),), db_count)
+
+    summary = (f'db={db_count};{db_time * 1000:.1f}ms;rows={rows} '
+               f's3={s3_count};{s3_time * 1000:.1f}ms '
+               f'total={elapsed * 1000:.1f}ms')
+    if header:
+        response.headers['X-Query-Summary'] = summary
+    if log:
+        query_log.info(f'{request.method} {request.path} ({route}) {summary}')
+
+    return response
+
+
+def enable_query_log():
+    ''' Makes query_log's lines appear, on stderr. Nothing configures the
+        root logger in the web process (gunicorn only sets up its own), so
+        at its default WARNING level it would drop them.
+    '''
+    query_log.setLevel(logging.INFO)
+    if not query_log.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(asctime)s %(name)s %(message)s'))
+        query_log.addHandler(handler)
+        # in case the root logger does get configured, don't log them twice
+        query_log.propagate = False
+
+
+def render(gauges: Dict[str, Dict] = None) -> str:
+    ''' All metrics in Prometheus' text format. `gauges` maps a name prefix
+        to a stats dict (like ConnectionPool.stats()), whose numbers are
+        exported as gauges.
+    '''
+    lines = []
+    for metric in ALL_METRICS:
+        lines.extend(metric.render())
+
+    for prefix, stats in (gauges or {}).items():
+        for name, value in sorted(flatten(stats).items()):
+            metric = f'shellsafe_{prefix}_{name}'
+            lines.append(f'# TYPE {metric} gauge')
+            lines.append(f'{metric} {float(value)}')
+
+    return '\n'.join(lines) + '\n'
+
+
+def flatten(stats: Dict, prefix='') -> Dict:
+    ''' {'hash': {'count': 1}} -> {'hash_count': 1}, dropping non-numbers '''
+    flat = {}
+    for key, value in stats.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f'{prefix}{key}_'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[f'{prefix}{key}'] = value
+    return flat
@@ -0,0 +1,164 @@
+''' Brings the database in DATABASE_URL up to date with the code.
+
+    Migrations are the numbered SQL files in migrations/, applied in order.
+    Each runs in its own transaction and is recorded in schema_migrations,
+    so it is applied once. They are also written to be safe to run again,
+    so databases changed by hand before this runner existed can be brought
+    under it by simply running it.
+
+    python migrate.py            apply any pending migrations
+    python migrate.py --status   list migrations and whether they're applied
+    python migrate.py --check    check the hot queries can use indexes
+
+    Runs as the release process in the Procfile, so deploys migrate first.
+'''
+
+import argparse
+import logging
+import os
+import sys
+
+import psycopg2
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+
+# arbitrary, but the same for every run, so two deploys can't migrate at once
+MIGRATION_LOCK = 7283401
+
+
+def migrations() -> [(str, str)]:
+    ''' (version, path) of each migration, in the order they apply '''
+    return [(name[:-len('.sql')], os.path.join(MIGRATIONS_DIR, name))
+            for name in sorted(os.listdir(MIGRATIONS_DIR))
+            if name.endswith('.sql')]
+
+
+def applied_versions(conn) -> {str}:
+    with conn:
+        cur = conn.cursor()
+        cur.execute('''CREATE TABLE IF NOT EXISTS schema_migrations (
+                           version    varchar(200) PRIMARY KEY,
+                           applied_at timestamptz  NOT NULL DEFAULT now()
+                       )''')
+        cur.execute('SELECT version FROM schema_migrations')
+        return {version for (version,) in cur.fetchall()}
+
+
+def migrate(conn) -> [str]:
+    ''' Applies pending migrations, returning the versions applied '''
+    cur = conn.cursor()
+    cur.execute('SELECT pg_advisory_lock(%s)', (MIGRATION_LOCK,))
+    conn.commit()
+    try:
+        done = applied_versions(conn)
+        applied = []
+        for version, path in migrations():
+            if version in done:
+                continue
+
+            logging.info(f'applying {version}')
+            with open(path) as f:
+                sql = f.read()
+            with conn:
+                cur = conn.cursor()
+                cur.execute(sql)
+                cur.execute('INSERT INTO schema_migrations (version) VALUES (%s)',
+                            (version,))
+            applied.append(version)
+        return applied
+    finally:
+        cur = conn.cursor()
+        cur.execute('SELECT pg_advisory_unlock(%s)', (MIGRATION_LOCK,))
+        conn.commit()
+
+
+# The queries most pages make, and the tables each must reach through an
+# index. Parameters only need to be plausible; the plan is what's checked.
+def hot_queries() -> [(str, str, object, {str})]:
+    # imported here so migrating doesn't need the app's dependencies
+    from persistence import user_artefacts_query
+
+    grid_sql, grid_where = user_artefacts_query(1, 1, 24)
+    filtered_sql, filtered_where = user_artefacts_query(1, 1, 24, tag_ids={1, 2})
+
+    return [
+        ('artefacts grid', grid_sql, grid_where,
+         {'user', 'artefact', 'artefactimage'}),
+        ('artefacts grid filtered by tags', filtered_sql, filtered_where,
+         {'user', 'artefact', 'artefactimage', 'artefacttaggedwith'}),
+        ('family members',
+         'SELECT id, first_name, surname FROM "user" WHERE family_id = %s', (1,),
+         {'user'}),
+        ('artefact images',
+         'SELECT * FROM ArtefactImage WHERE artefact_id = %s ORDER BY image_id', (1,),
+         {'artefactimage'}),
+        ('tags by name',
+         'SELECT tag_id, name FROM Tag WHERE name IN %s', (('a', 'b'),),
+         {'tag'}),
+    ]
+
+
+def seq_scans(plan) -> [str]:
+    ''' Names of the tables the plan reads by sequential scan '''
+    scans = []
+    if plan.get('Node Type') == 'Seq Scan':
+        scans.append(plan['Relation Name'])
+    for child in plan.get('Plans', []):
+        scans.extend(seq_scans(child))
+    return scans
+
+
+def check_indexes(conn) -> bool:
+    ''' Explains each hot query and reports any that still scan a table it
+        should reach through an index. Sequential scans are switched off
+        for this, so a test database too small to bother with indexes still
+        shows whether a usable one exists.
+    '''
+    ok = True
+    cur = conn.cursor()
+    cur.execute('SET LOCAL enable_seqscan = off')
+    for name, sql, params, tables in hot_queries():
+        cur.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        [[explained]] = cur.fetchone()
+        scanned = sorted(tables.intersection(seq_scans(explained['Plan'])))
+        if scanned:
+            ok = False
+            print(f'FAIL {name}: sequential scan of {", ".join(scanned)}')
+        else:
+            print(f'ok   {name}')
+    conn.rollback()
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--status', action='store_true')
+    parser.add_argument('--check', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    db_URL = os.environ.get('DATABASE_URL')
+    if db_URL is None:
+        sys.exit('DATABASE_URL not set')
+
+    conn = psycopg2.connect(db_URL)
+    try:
+        if args.status:
+            done = applied_versions(conn)
+            for version, _ in migrations():
+                print(f'{"applied" if version in done else "pending":8} {version}')
+        elif args.check:
+            if not check_indexes(conn):
+                sys.exit(1)
+        else:
+            applied = migrate(conn)
+            logging.info(f'applied {len(applied)} migration(s)' if applied
+                         else 'already up to date')
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
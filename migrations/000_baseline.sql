@@ -0,0 +1,59 @@
+-- The schema as the app found it before migrations were numbered. Every
+-- statement is a no-op on a database that already has it, so this is safe
+-- to run against production as well as an empty database.
+
+CREATE TABLE IF NOT EXISTS Family (
+    family_id     serial PRIMARY KEY,
+    name          varchar(100) NOT NULL,
+    referral_code varchar(120) NOT NULL,
+        UNIQUE(referral_code)
+);
+
+DO $$
+BEGIN
+    CREATE TYPE stored_with AS ENUM('user', 'location');
+EXCEPTION
+    WHEN duplicate_object THEN NULL;
+END
+$$;
+
+-- get_user_row and app.User read this by position, so keep the order
+CREATE TABLE IF NOT EXISTS "user" (
+    id          serial PRIMARY KEY,
+    first_name  varchar(100)                         NOT NULL,
+    email       varchar(100)                         NOT NULL,
+    password    bytea                                NOT NULL,
+    location    varchar(200),
+    family_id   integer REFERENCES Family(family_id) NOT NULL,
+    surname     varchar(100)                         NOT NULL,
+      UNIQUE(email)
+);
+
+CREATE TABLE IF NOT EXISTS Artefact (
+    artefact_id      serial PRIMARY KEY,
+    owner            integer REFERENCES "user"(id) NOT NULL,
+    name             varchar(100)                  NOT NULL,
+    description      text,
+    date_stored      timestamp,
+    stored_with      stored_with,
+    stored_with_user integer REFERENCES "user"(id),
+    stored_at_loc    varchar(200)
+);
+
+CREATE TABLE IF NOT EXISTS ArtefactImage (
+    image_id          serial PRIMARY KEY,
+    artefact_id       integer REFERENCES Artefact(artefact_id) NOT NULL,
+    image_url         varchar(1024)                            NOT NULL,
+    image_description text
+);
+
+CREATE TABLE IF NOT EXISTS Tag (
+    tag_id serial PRIMARY KEY,
+    name   varchar(50) NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS ArtefactTaggedWith (
+    artefact_id integer REFERENCES Artefact(artefact_id),
+    tag_id      integer REFERENCES Tag(tag_id),
+    PRIMARY KEY (artefact_id, tag_id)
+);
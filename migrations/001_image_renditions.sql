@@ -0,0 +1,5 @@
+-- Smaller copies of each image, stored next to the original in S3. NULL
+-- for images uploaded before renditions existed, or whose renditions
+-- couldn't be made; the original is shown instead.
+ALTER TABLE ArtefactImage ADD COLUMN IF NOT EXISTS thumb_url  varchar(1024);
+ALTER TABLE ArtefactImage ADD COLUMN IF NOT EXISTS medium_url varchar(1024);
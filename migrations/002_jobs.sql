@@ -0,0 +1,22 @@
+-- Background work queued by the web app and run by worker.py (see jobs.py).
+CREATE TABLE IF NOT EXISTS Job (
+    job_id       serial PRIMARY KEY,
+    kind         varchar(50)                                          NOT NULL,
+    payload      jsonb                                                NOT NULL DEFAULT '{}',
+    artefact_id  integer REFERENCES Artefact(artefact_id) ON DELETE CASCADE,
+    status       varchar(20)                                          NOT NULL DEFAULT 'queued',
+    attempts     integer                                              NOT NULL DEFAULT 0,
+    max_attempts integer                                              NOT NULL DEFAULT 5,
+    run_after    timestamptz                                          NOT NULL DEFAULT now(),
+    locked_until timestamptz,
+    last_error   text,
+    created_at   timestamptz                                          NOT NULL DEFAULT now(),
+    updated_at   timestamptz                                          NOT NULL DEFAULT now()
+);
+
+-- what workers scan when looking for something to do
+CREATE INDEX IF NOT EXISTS job_runnable
+    ON Job (run_after)
+    WHERE status IN ('queued', 'running');
+
+CREATE INDEX IF NOT EXISTS job_artefact_id ON Job (artefact_id);
@@ -0,0 +1,25 @@
+-- Full text search over artefacts. search_vector holds an artefact's name,
+-- tag names and description, weighted in that order, and is recomputed by
+-- the app (persistence.update_search_vectors) whenever any of them change.
+CREATE OR REPLACE FUNCTION artefact_search_vector(id integer) RETURNS tsvector AS $$
+    SELECT setweight(to_tsvector('english', Artefact.name), 'A')
+        || setweight(to_tsvector('english', COALESCE((
+               SELECT string_agg(Tag.name, ' ')
+               FROM ArtefactTaggedWith
+               INNER JOIN Tag
+               ON Tag.tag_id = ArtefactTaggedWith.tag_id
+               WHERE ArtefactTaggedWith.artefact_id = Artefact.artefact_id
+           ), '')), 'B')
+        || setweight(to_tsvector('english', COALESCE(Artefact.description, '')), 'C')
+    FROM Artefact
+    WHERE Artefact.artefact_id = id
+$$ LANGUAGE sql STABLE;
+
+ALTER TABLE Artefact ADD COLUMN IF NOT EXISTS search_vector tsvector;
+
+UPDATE Artefact
+SET search_vector = artefact_search_vector(artefact_id)
+WHERE search_vector IS NULL;
+
+CREATE INDEX IF NOT EXISTS artefact_search_vector
+    ON Artefact USING gin (search_vector);
@@ -0,0 +1,39 @@
+-- Indexes for the joins every page makes. Without them the family grid,
+-- family membership and tag filtering all scan whole tables.
+-- `python migrate.py --check` confirms the hot queries use them.
+
+-- artefacts of the family's members
+CREATE INDEX IF NOT EXISTS artefact_owner ON Artefact (owner);
+
+-- a family's members
+CREATE INDEX IF NOT EXISTS user_family_id ON "user" (family_id);
+
+-- an artefact's images, first image first
+CREATE INDEX IF NOT EXISTS artefactimage_artefact_id
+    ON ArtefactImage (artefact_id, image_id);
+
+-- the artefacts with a tag (the primary key covers the other direction)
+CREATE INDEX IF NOT EXISTS artefacttaggedwith_tag_id
+    ON ArtefactTaggedWith (tag_id, artefact_id);
+
+-- tag_artefact looks tags up by name and relies on there being one of
+-- each. Merge any duplicates into the oldest before making that so.
+INSERT INTO ArtefactTaggedWith (artefact_id, tag_id)
+SELECT ArtefactTaggedWith.artefact_id, keep.tag_id
+FROM ArtefactTaggedWith
+INNER JOIN Tag
+ON Tag.tag_id = ArtefactTaggedWith.tag_id
+INNER JOIN (SELECT name, MIN(tag_id) AS tag_id FROM Tag GROUP BY name) AS keep
+ON keep.name = Tag.name AND keep.tag_id <> Tag.tag_id
+ON CONFLICT DO NOTHING;
+
+DELETE FROM ArtefactTaggedWith
+USING Tag, (SELECT name, MIN(tag_id) AS tag_id FROM Tag GROUP BY name) AS keep
+WHERE Tag.tag_id = ArtefactTaggedWith.tag_id
+  AND keep.name = Tag.name AND keep.tag_id <> Tag.tag_id;
+
+DELETE FROM Tag
+USING (SELECT name, MIN(tag_id) AS tag_id FROM Tag GROUP BY name) AS keep
+WHERE keep.name = Tag.name AND keep.tag_id <> Tag.tag_id;
+
+CREATE UNIQUE INDEX IF NOT EXISTS tag_name ON Tag (name);
@@ -0,0 +1,5 @@
+-- Cheap version stamps for conditional GETs (see conditional.py). An
+-- artefact's updated_at changes whenever anything on its page does, and a
+-- family's revision whenever anything on its artefacts grid does.
+ALTER TABLE Artefact ADD COLUMN IF NOT EXISTS updated_at timestamptz NOT NULL DEFAULT now();
+ALTER TABLE Family   ADD COLUMN IF NOT EXISTS revision   bigint      NOT NULL DEFAULT 0;
@@ -0,0 +1,13 @@
+-- The image shown on an artefact's card, so the grid can join straight to
+-- it instead of searching each artefact's images for the first. New
+-- artefacts get their first image; owners can pick another.
+ALTER TABLE Artefact ADD COLUMN IF NOT EXISTS cover_image_id integer
+    REFERENCES ArtefactImage(image_id) ON DELETE SET NULL;
+
+UPDATE Artefact
+SET cover_image_id = FirstImage.image_id
+FROM (SELECT artefact_id, MIN(image_id) AS image_id
+      FROM ArtefactImage
+      GROUP BY artefact_id) AS FirstImage
+WHERE FirstImage.artefact_id = Artefact.artefact_id
+  AND Artefact.cover_image_id IS NULL;
@@ -36,11 +36,30 @@ Register = namedtuple("Register", ("first_name",
                                    "location",
                                    "password"))
 
+# thumb_url and medium_url are the keys of smaller renditions of the image,
+# or None if it doesn't have them
 ArtefactImage = namedtuple("ArtefactImage", ("image_id",
                                              "artefact_id",
                                              "image_url",
-                                             "image_description"))
+                                             "image_description",
+                                             "thumb_url",
+                                             "medium_url"),
+                           defaults=(None, None))
 
 Tag = namedtuple("Tag", ("tag_id", "name"))
 
+# Everything the artefact page shows, loaded in one go. location is resolved
+# from the keeper's address when the artefact is stored with a user.
+ArtefactDetail = namedtuple("ArtefactDetail", ("artefact",
+                                               "owner",             # User
+                                               "location",
+                                               "images",            # [ArtefactImage]
+                                               "tags",              # [Tag]
+                                               "viewer_has_access",
+                                               "media_pending"))    # images still being processed
+
+# One page of a keyset-paginated listing. The cursors are opaque strings to
+# pass back as ?after= / ?before=, or None if there is no such page.
+Page = namedtuple("Page", ("items", "next_cursor", "prev_cursor"))
+
 example_artefact = Artefact(None, "Spellbook", 1, "old and spooky", None, 'user', 1, None)
@@ -0,0 +1,254 @@
+''' Password hashing and checking.
+
+    bcrypt is deliberately slow. Under gevent workers (see gunicorn.conf.py)
+    hashing inline would block the worker's event loop, and every request it
+    is serving, for the whole time. Instead the work is handed to a small
+    pool of OS threads; bcrypt releases the GIL while it hashes, so they run
+    in parallel with the event loop. Only a limited number of requests per
+    worker may be hashing or waiting to at once; beyond that we fail fast
+    with PasswordServiceBusy (which the app turns into a 503) rather than
+    letting a burst of logins queue up behind each other and starve every
+    other page.
+
+    Sync workers serve one request at a time, so there is nothing for the
+    worker to do while it waits on a hash, and they hash inline. What has to
+    be bounded there is how many of the dyno's workers are hashing at once,
+    or a login storm takes every one of them. So a sync worker must first
+    take one of PASSWORD_SYNC_SLOTS lock files, which all the workers on the
+    machine share, and if none is free it fails fast with the same 503.
+
+    Hashes are plain bcrypt, so they're interchangeable with the ones
+    flask-bcrypt made before.
+'''
+
+import fcntl
+import os
+import tempfile
+import threading
+import time
+
+from concurrent.futures import TimeoutError
+from typing import Dict
+
+import bcrypt
+
+
+# bcrypt cost factor for new hashes. Existing hashes keep the cost they were
+# made with.
+BCRYPT_LOG_ROUNDS = int(os.environ.get("BCRYPT_LOG_ROUNDS", 12))
+
+# threads doing the hashing, per gevent web worker
+PASSWORD_WORKERS = int(os.environ.get("PASSWORD_WORKERS", 2))
+
+# how many requests per gevent web worker may be hashing or waiting to hash
+# at once
+PASSWORD_QUEUE_LIMIT = int(os.environ.get("PASSWORD_QUEUE_LIMIT", 8))
+
+# seconds a request will wait for its hash before giving up
+PASSWORD_TIMEOUT = float(os.environ.get("PASSWORD_TIMEOUT", 10))
+
+# how many sync web workers, between them, may be hashing at once. Half of
+# them by default, so the rest are left for pages during a login storm.
+PASSWORD_SYNC_SLOTS = int(os.environ.get(
+        "PASSWORD_SYNC_SLOTS", max(1, int(os.environ.get("WEB_CONCURRENCY", 2)) // 2)))
+
+# where the sync workers' slot lock files live. Must be on the machine's own
+# disk, shared by all its workers.
+PASSWORD_SLOT_DIR = os.environ.get(
+        "PASSWORD_SLOT_DIR", os.path.join(tempfile.gettempdir(), 'shellsafe-password-slots'))
+
+
+class PasswordServiceBusy(Exception):
+    ''' Raised when too many passwords are already being hashed '''
+
+
+def _hash(password: bytes, rounds: int) -> bytes:
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+def _check(pw_hash: bytes, password: bytes) -> bool:
+    return bcrypt.checkpw(password, pw_hash)
+
+
+def _gevent_patched() -> bool:
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('threading')
+
+
+class _Job:
+    ''' A hash to run on the pool, unless it's been given up on by the time
+        a thread gets to it. (gevent's futures can't be cancelled.)
+    '''
+
+    def __init__(self, fn, args):
+        self.fn = fn
+        self.args = args
+        self.cancelled = False
+
+    def __call__(self):
+        if self.cancelled:
+            return None
+        return self.fn(*self.args)
+
+
+class SlotFiles:
+    ''' A limit on how many processes can be doing something at once, shared
+        by every process on the machine: each holds an flock on one of
+        `count` files while it works. The kernel drops the lock if a process
+        dies, so a killed worker can't leak its slot.
+    '''
+
+    def __init__(self, directory: str, count: int):
+        self.directory = directory
+        self.count = count
+
+    def acquire(self):
+        ''' Takes a free slot without waiting, returning it to pass to
+            release(), or None if they're all taken.
+        '''
+        os.makedirs(self.directory, exist_ok=True)
+        for i in range(self.count):
+            fd = os.open(os.path.join(self.directory, f'slot-{i}'), os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except BlockingIOError:
+                os.close(fd)
+        return None
+
+    def release(self, slot):
+        # closing the file drops the lock
+        os.close(slot)
+
+
+class PasswordHasher:
+
+    def __init__(self, workers: int, queue_limit: int, timeout: float, offload: bool,
+                 shared_slots: SlotFiles = None):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.timeout = timeout
+        self.offload = offload
+        # taken around inline hashing, when not offloading
+        self.shared_slots = shared_slots
+
+        self._slots = threading.BoundedSemaphore(queue_limit)
+        self._executor = None
+        self._lock = threading.Lock()
+
+        # operation -> [count, total seconds, max seconds]
+        self._latency = {'hash': [0, 0.0, 0.0], 'check': [0, 0.0, 0.0]}
+        self.rejected = 0
+
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                # native threads, even though threading is patched
+                from gevent.threadpool import ThreadPoolExecutor
+                self._executor = ThreadPoolExecutor(max_workers=self.workers)
+            return self._executor
+
+    def run(self, operation: str, fn, *args):
+        if not self.offload:
+            return self._run_inline(operation, fn, *args)
+
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise PasswordServiceBusy("too many passwords being hashed")
+
+        job = _Job(fn, args)
+        try:
+            future = self.executor().submit(job)
+        except BaseException:
+            self._slots.release()
+            raise
+        # The slot is held until the hash is done, not just until we stop
+        # waiting for it, so hashes that time out still count against the
+        # limit rather than piling up behind new ones. The callback runs on
+        # the event loop, where the semaphore lives.
+        future.add_done_callback(lambda _: self._slots.release())
+
+        try:
+            return self._timed(operation, future.result, self.timeout)
+        except TimeoutError:
+            # if it hasn't started yet, it needn't
+            job.cancelled = True
+            with self._lock:
+                self.rejected += 1
+            raise PasswordServiceBusy("timed out waiting to hash password")
+
+    def _run_inline(self, operation: str, fn, *args):
+        if self.shared_slots is None:
+            return self._timed(operation, fn, *args)
+
+        slot = self.shared_slots.acquire()
+        if slot is None:
+            with self._lock:
+                self.rejected += 1
+            raise PasswordServiceBusy("too many passwords being hashed")
+        try:
+            return self._timed(operation, fn, *args)
+        finally:
+            self.shared_slots.release(slot)
+
+    def _timed(self, operation: str, fn, *args):
+        start = time.monotonic()
+        try:
+            return fn(*args)
+        finally:
+            elapsed = time.monotonic() - start
+            with self._lock:
+                latency = self._latency[operation]
+                latency[0] += 1
+                latency[1] += elapsed
+                latency[2] = max(latency[2], elapsed)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = {
+                'offloaded': self.offload,
+                'workers': self.workers,
+                'queue_limit': self.queue_limit,
+                'rejected': self.rejected,
+            }
+            for operation, (count, total, longest) in self._latency.items():
+                stats[operation] = {
+                    'count': count,
+                    'latency_total': total,
+                    'latency_avg': total / count if count else 0.0,
+                    'latency_max': longest,
+                }
+            return stats
+
+
+# one per web worker process, like the connection pool
+_hashers = {}
+_hashers_lock = threading.Lock()
+
+def get_hasher() -> PasswordHasher:
+    pid = os.getpid()
+    with _hashers_lock:
+        if pid not in _hashers:
+            if _gevent_patched():
+                _hashers[pid] = PasswordHasher(PASSWORD_WORKERS,
+                                               PASSWORD_QUEUE_LIMIT,
+                                               PASSWORD_TIMEOUT,
+                                               offload=True)
+            else:
+                _hashers[pid] = PasswordHasher(1,
+                                               PASSWORD_SYNC_SLOTS,
+                                               PASSWORD_TIMEOUT,
+                                               offload=False,
+                                               shared_slots=SlotFiles(PASSWORD_SLOT_DIR,
+                                                                      PASSWORD_SYNC_SLOTS))
+        return _hashers[pid]
+
+
+def hash_password(password: str) -> bytes:
+    return get_hasher().run('hash', _hash, password.encode('utf-8'), BCRYPT_LOG_ROUNDS)
+
+def check_password(pw_hash: bytes, password: str) -> bool:
+    return get_hasher().run('check', _check, bytes(pw_hash), password.encode('utf-8'))
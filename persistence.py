@@ -1,37 +1,64 @@
-from typing import List, Tuple, Dict
+from typing import Iterator, List, Tuple, Dict, Set
 from datetime import datetime
+from decimal import Decimal, InvalidOperation
+import base64
+import logging
+import os
+import threading
+import time
+import uuid
 
-from flask import current_app
 from flask_login import current_user
 from werkzeug.datastructures import FileStorage
 import psycopg2
+import psycopg2.extras
 
 import boto3
+from botocore.exceptions import ClientError
+from PIL import Image, ImageOps
 
 import string
 import random
 
-from collections import defaultdict
+from io import BytesIO
+from tempfile import SpooledTemporaryFile
+from concurrent.futures import ThreadPoolExecutor
 
 from model import (
         Artefact,
         Credentials,
         Register,
         ArtefactImage,
-        ArtefactUser,
         User,
-        Tag
+        Tag,
+        Page,
+        ArtefactDetail
 )
+from cache import TTLCache
+from metrics import instrument_s3_client, record_s3_call
+from pool import db_conn
 
 ############
 # Database #
 ############
 
+# Artefact's columns, in the order of the Artefact fields. The table has
+# more (search_vector) that the model doesn't carry, so select these rather
+# than Artefact.* wherever rows become Artefacts.
+ARTEFACT_COLUMNS = '''Artefact.artefact_id, Artefact.owner, Artefact.name,
+    Artefact.description, Artefact.date_stored, Artefact.stored_with,
+    Artefact.stored_with_user, Artefact.stored_at_loc'''
+
+# ArtefactImage's columns, in the order of the ArtefactImage fields
+IMAGE_COLUMNS = '''ArtefactImage.image_id, ArtefactImage.artefact_id,
+    ArtefactImage.image_url, ArtefactImage.image_description,
+    ArtefactImage.thumb_url, ArtefactImage.medium_url'''
+
 
 def row_to_artefact_preview(row: Tuple) -> Dict:
     '''
     takes a row consisting of the artefact fields, user first and last names,
-    and optionally the first ArtefactImage associated with that artefact
+    and optionally the artefact's cover ArtefactImage
     and collates them into a dict like this:
 
     {
@@ -39,6 +66,7 @@ def row_to_artefact_preview(row: Tuple) -> Dict:
         'first_name': str
         'last_name': str
         'image': ArtefactImage or None
+        'updated_at': datetime
     }
     '''
 
@@ -48,49 +76,13 @@ def row_to_artefact_preview(row: Tuple) -> Dict:
     d['last_name'] = row[9]
 
     # artefact may not have any images associated with it
-    d['image'] = (img_with_presigned_url(ArtefactImage(*(row[10:])))
+    d['image'] = (img_with_presigned_url(ArtefactImage(*(row[10:16])))
                   if row[10] is not None
                   else None)
+    d['updated_at'] = row[16]
 
     return d
 
-def get_tags_of_artefacts(artefact_ids: [int]) -> [Tag]:
-    if len(artefact_ids) == 0:
-        return []
-
-    sql = '''
-    SELECT DISTINCT tag_id, name
-    FROM Tag
-    NATURAL JOIN ArtefactTaggedWith
-    WHERE artefact_id IN %(artefact_ids)s
-    '''
-
-    where = {'artefact_ids': tuple(artefact_ids)}
-    # print("where:")
-    # print(where)
-
-    rows = pg_select(sql, where)
-    return [Tag(*row) for row in rows]
-
-def get_tags_of_each_artefact(artefact_ids: [int]) -> Dict:
-    ''' Return dict mapping each artefact_id to a list of tags '''
-
-    if len(artefact_ids) == 0:
-        return {}
-
-    sql = '''
-    SELECT artefact_id, tag_id, Tag.name FROM ArtefactTaggedWith
-    NATURAL JOIN Tag
-    WHERE artefact_id in %(artefact_ids)s
-    '''
-
-    where = {'artefact_ids': tuple(artefact_ids)}
-
-    rows = pg_select(sql, where)
-    rows = [(artefact_id, Tag(tag_id, tag_name))
-            for (artefact_id, tag_id, tag_name) in rows]
-    return groupBy_first(rows)
-
 def get_tags_by_ids(ids):
     sql = '''SELECT * FROM tag
              WHERE tag_id in %(ids)s'''
@@ -102,45 +94,168 @@ def get_tags_by_ids(ids):
     tags = [Tag(*row) for row in rows]
     return tags
 
-def get_user_artefacts(user_id, family_id) -> List[Dict]:
-    ''' Returns the artefacts that the user is able to view. '''
+def get_family_tags(family_id) -> [Tag]:
+    ''' Returns every tag used on an artefact belonging to the family '''
 
     sql = '''
-    SELECT DISTINCT ON (Artefact.artefact_id)
-        Artefact.*, "user".first_name, "user".surname, ArtefactImage.*
-    FROM "user"
+    SELECT DISTINCT Tag.tag_id, Tag.name
+    FROM Tag
+    INNER JOIN ArtefactTaggedWith
+    ON ArtefactTaggedWith.tag_id = Tag.tag_id
     INNER JOIN Artefact
+    ON Artefact.artefact_id = ArtefactTaggedWith.artefact_id
+    INNER JOIN "user"
     ON Artefact.owner = "user".id
-    LEFT JOIN ArtefactImage
-    ON Artefact.artefact_id = ArtefactImage.artefact_id
     WHERE "user".family_id = %(family_id)s'''
 
-    rows = pg_select(sql=sql, where={"user_id": user_id, "family_id": family_id})
+    rows = pg_select(sql, {'family_id': family_id})
+    return [Tag(*row) for row in rows]
+
+def encode_cursor(sort_key, artefact_id: int) -> str:
+    ''' A cursor marks a position in the (sort_key, artefact_id) ordering of
+        the artefacts grid. sort_key is date_stored, or the search rank when
+        searching.
+    '''
+    if isinstance(sort_key, datetime):
+        sort_key = sort_key.isoformat()
+    key = f'{sort_key}|{artefact_id}'
+    return base64.urlsafe_b64encode(key.encode()).decode()
+
+def decode_cursor(cursor: str, ranked=False) -> Tuple:
+    ''' Returns (date_stored, artefact_id), or (rank, artefact_id) if ranked.
+        Raises ValueError if the cursor is malformed.
+    '''
+    try:
+        key = base64.urlsafe_b64decode(cursor.encode()).decode()
+        sort_key, artefact_id = key.split('|')
+        if ranked:
+            rank = Decimal(sort_key)
+            if not rank.is_finite():
+                raise ValueError("rank must be a number")
+            return rank, int(artefact_id)
+        return datetime.fromisoformat(sort_key), int(artefact_id)
+    except (UnicodeError, TypeError, ValueError, InvalidOperation) as e:
+        raise ValueError(f"invalid cursor: {cursor}") from e
+
+def get_user_artefacts(user_id, family_id,
+                       page_size: int = 24,
+                       after: str = None,
+                       before: str = None,
+                       tag_ids: Set[int] = None,
+                       query: str = None) -> Page:
+    ''' Returns one page of the artefacts that the user is able to view,
+        newest first. If tag_ids is given, only artefacts tagged with every
+        one of those tags are included.
+
+        If query is given, only artefacts whose name, tags or description
+        match it are included, best match first. It's in web search syntax:
+        "quoted phrases", or, and -excluded words.
+
+        Pass the next_cursor of a page as `after` to get the page following
+        it, or the prev_cursor as `before` to get the one preceding it.
+        Paging is by keyset rather than offset, so every page costs the same
+        however deep into the collection it is.
+    '''
+
+    sql, where = user_artefacts_query(user_id, family_id, page_size,
+                                      after, before, tag_ids, query)
+    rows = pg_select(sql=sql, where=where)
+
+    # we fetched one extra row to find out whether there's a page beyond
+    # this one
+    more = len(rows) > page_size
+    rows = rows[:page_size]
+    if before is not None:
+        rows.reverse()
 
     previews = [row_to_artefact_preview(row) for row in rows]
-    return previews
+    if not previews:
+        return Page(previews, None, None)
+
+    first = encode_cursor(rows[0][-1], rows[0][0])
+    last = encode_cursor(rows[-1][-1], rows[-1][0])
+
+    if before is not None:
+        return Page(previews, last, first if more else None)
+    elif after is not None:
+        return Page(previews, last if more else None, first)
+    else:
+        return Page(previews, last if more else None, None)
 
-def groupBy_first(lst):
-    ''' Convert a list of key value pairs to a dict mapping each key to a list 
-        of the values with that key
+def user_artefacts_query(user_id, family_id, page_size, after=None, before=None,
+                         tag_ids=None, query=None) -> Tuple[str, Dict]:
+    ''' The query behind get_user_artefacts, and its parameters. One more
+        row than page_size is asked for.
     '''
-    d = defaultdict(list)
-    for (fst, snd) in lst:
-        d[fst].append(snd)
 
-    return d
+    where = {"user_id": user_id,
+             "family_id": family_id,
+             "limit": page_size + 1}
+
+    if query:
+        where["query"] = query
+        # As an exact numeric, so the rank survives the round trip through a
+        # cursor. A float's text form can be rounded (extra_float_digits=0
+        # on postgres 11), which would make a page's cursor point before it.
+        sort_key = '''round(ts_rank(Artefact.search_vector,
+                                    websearch_to_tsquery('english', %(query)s))::numeric, 8)'''
+        search = '''AND Artefact.search_vector
+                      @@ websearch_to_tsquery('english', %(query)s)'''
+    else:
+        sort_key = 'Artefact.date_stored'
+        search = ''
+
+    if after is not None:
+        where["sort_key"], where["artefact_id"] = decode_cursor(after, ranked=bool(query))
+        keyset = f'''AND ({sort_key}, Artefact.artefact_id)
+                      < (%(sort_key)s, %(artefact_id)s)'''
+        order = 'DESC'
+    elif before is not None:
+        where["sort_key"], where["artefact_id"] = decode_cursor(before, ranked=bool(query))
+        keyset = f'''AND ({sort_key}, Artefact.artefact_id)
+                      > (%(sort_key)s, %(artefact_id)s)'''
+        order = 'ASC'
+    else:
+        keyset = ''
+        order = 'DESC'
+
+    if tag_ids:
+        # relational division: the artefacts having as many of the wanted
+        # tags as there are wanted tags
+        where["tag_ids"] = tuple(tag_ids)
+        where["tag_count"] = len(where["tag_ids"])
+        tag_filter = '''AND Artefact.artefact_id IN (
+        SELECT artefact_id FROM ArtefactTaggedWith
+        WHERE tag_id IN %(tag_ids)s
+        GROUP BY artefact_id
+        HAVING COUNT(DISTINCT tag_id) = %(tag_count)s)'''
+    else:
+        tag_filter = ''
+
+    # Each card shows just the artefact's cover image, which it points at
+    # directly. The sort key goes last, to make the cursors from.
+    sql = f'''
+    SELECT {ARTEFACT_COLUMNS}, "user".first_name, "user".surname, {IMAGE_COLUMNS},
+        Artefact.updated_at, {sort_key}
+    FROM Artefact
+    INNER JOIN "user"
+    ON Artefact.owner = "user".id
+    LEFT JOIN ArtefactImage
+    ON ArtefactImage.image_id = Artefact.cover_image_id
+    WHERE "user".family_id = %(family_id)s
+    {search}
+    {keyset}
+    {tag_filter}
+    ORDER BY {sort_key} {order}, Artefact.artefact_id {order}
+    LIMIT %(limit)s'''
+
+    return sql, where
 
 def pg_select(sql: str, where=None) -> List[Tuple]:
     ''' sql: A select statement
         can now work with input dicts
     '''
-    try:
-        conn = psycopg2.connect(current_app.config['db_URL'])
-    except e:
-        print("couldn't connect to " + current_app.config['db_URL'])
-        raise e
-
-    with conn:
+    with db_conn() as conn:
         cur = conn.cursor()
         if where is not None:
             # print("running query: ")
@@ -152,39 +267,76 @@ def pg_select(sql: str, where=None) -> List[Tuple]:
 
         return cur.fetchall()
 
+# rows pg_stream fetches from the server at a time
+DB_STREAM_ITERSIZE = int(os.environ.get("DB_STREAM_ITERSIZE", 2000))
+
+def pg_stream(sql: str, where=None, itersize=DB_STREAM_ITERSIZE) -> Iterator[Tuple]:
+    ''' Like pg_select, but yields rows as it goes rather than returning a
+        list. Uses a server-side cursor, fetching itersize rows per round
+        trip, so memory stays flat however big the result.
+
+        A pooled connection, and a transaction on it, are held until the
+        iteration finishes (or the generator is closed). So consume it
+        promptly: don't wait on S3, the client or anything else slow between
+        rows, or the connection is kept from the pool and the open
+        transaction holds back vacuum and blocks migrations. Page through
+        the rows instead, as iter_family_images does.
+    '''
+    with db_conn() as conn:
+        # named cursors live on the server, and need a transaction
+        with conn.cursor(name=f'pg_stream_{uuid.uuid4().hex}') as cur:
+            cur.itersize = itersize
+            cur.execute(sql, where)
+            yield from cur
+
+# Rows read per query by the paged iter_* functions. Each page is its own
+# short query, so however slowly the rows are used (an export waits on S3
+# and the client between them), no connection or transaction is held
+# meanwhile.
+DB_PAGE_SIZE = int(os.environ.get("DB_PAGE_SIZE", 500))
+
+
+# (artefact_id, whether the viewer owns it) -> (updated_at, rendered card HTML)
+# for the artefacts grid. See views.render_card.
+card_cache = TTLCache(maxsize=int(os.environ.get("CARD_CACHE_SIZE", 5000)),
+                      ttl=float(os.environ.get("CARD_CACHE_TTL", 3600)))
+
+# family_id -> its members, for showing. Membership rarely changes but is
+# needed on most requests. Anything that adds a user to a family or changes
+# a member's name must pop the family from here, which only reaches this
+# worker's copy, so don't use it to decide what a user may do.
+family_cache = TTLCache(maxsize=int(os.environ.get("FAMILY_CACHE_SIZE", 1000)),
+                        ttl=float(os.environ.get("FAMILY_CACHE_TTL", 300)))
 
 ''' Returns a family with the ids and users '''
 def get_family(family_id) -> List[User]:
-    inputs = {"family_id": family_id}
+    users = family_cache.get(family_id)
+    if users is None:
+        inputs = {"family_id": family_id}
 
-    sql = '''SELECT id, first_name, surname
-             FROM "user"
-             WHERE family_id = %(family_id)s'''
+        sql = '''SELECT id, first_name, surname
+                 FROM "user"
+                 WHERE family_id = %(family_id)s'''
 
-    rows = pg_select(sql=sql, where=inputs)
+        rows = pg_select(sql=sql, where=inputs)
 
-    return [User(*row) for row in rows]
+        users = tuple(User(*row) for row in rows)
+        family_cache.set(family_id, users)
+    return list(users)
 
 
 def get_current_user_family() -> List[User]:
     return get_family(current_user.family_id)
 
 
-# Returns the list of users ids for a given family
-def family_user_ids(family_id) -> List[int]:
-
-    inputs = {"family_id": family_id}
-
-    sql = '''SELECT id
-             FROM "user"
-             WHERE family_id = %(family_id)s'''
-
-    rows = pg_select(sql=sql, where=inputs)
-    
-    return [row[0] for row in rows]
-    # return rows
+def user_in_family(user_id, family_id) -> bool:
+    ''' Asks the database rather than family_cache: this guards writes, and
+        other workers' copies of the family can be out of date.
+    '''
+    sql = '''SELECT 1 FROM "user"
+             WHERE id = %(user_id)s AND family_id = %(family_id)s'''
 
-    # return [row(0) for row in rows]
+    return bool(pg_select(sql, {"user_id": user_id, "family_id": family_id}))
 
 
 def get_artefacts(artefact_ids=None) -> [Artefact]:
@@ -193,17 +345,18 @@ def get_artefacts(artefact_ids=None) -> [Artefact]:
     '''
 
     if artefact_ids is None:
-        rows = pg_select('SELECT * FROM Artefact;')
+        # every one of them; iter_artefacts if you don't need them in a list
+        return list(iter_artefacts())
 
     elif type(artefact_ids) == int:
-        rows = pg_select('SELECT * from Artefact WHERE artefact_id=%s',
+        rows = pg_select(f'SELECT {ARTEFACT_COLUMNS} from Artefact WHERE artefact_id=%s',
                 (artefact_ids,))
 
     elif type(artefact_ids) == list:
         if len(artefact_ids) == 0:
             rows = []
         else:
-            rows = pg_select('SELECT * from Artefact WHERE artefact_id IN %s',
+            rows = pg_select(f'SELECT {ARTEFACT_COLUMNS} from Artefact WHERE artefact_id IN %s',
                     (artefact_ids,))
     else:
         raise ValueError("artefact_ids must be an int or list of ints")
@@ -211,6 +364,170 @@ def get_artefacts(artefact_ids=None) -> [Artefact]:
     return [Artefact(*row) for row in rows]
 
 
+def iter_artefacts(family_id=None, itersize=DB_STREAM_ITERSIZE) -> Iterator[Artefact]:
+    ''' Every artefact, or every one owned by a member of family_id, in id
+        order. Streamed through pg_stream, so see there before doing anything
+        slow with each one.
+    '''
+    if family_id is None:
+        sql = f'SELECT {ARTEFACT_COLUMNS} FROM Artefact ORDER BY artefact_id'
+    else:
+        sql = f'''SELECT {ARTEFACT_COLUMNS}
+                  FROM Artefact
+                  INNER JOIN "user"
+                  ON "user".id = Artefact.owner
+                  WHERE "user".family_id = %(family_id)s
+                  ORDER BY Artefact.artefact_id'''
+
+    for row in pg_stream(sql, {'family_id': family_id}, itersize):
+        yield Artefact(*row)
+
+
+def iter_artefact_images(family_id=None, itersize=DB_STREAM_ITERSIZE) -> Iterator[ArtefactImage]:
+    ''' Like iter_artefacts, for images, ordered by artefact then image.
+        The URLs are S3 keys, not presigned.
+    '''
+    if family_id is None:
+        sql = f'''SELECT {IMAGE_COLUMNS} FROM ArtefactImage
+                  ORDER BY ArtefactImage.artefact_id, ArtefactImage.image_id'''
+    else:
+        sql = f'''SELECT {IMAGE_COLUMNS}
+                  FROM ArtefactImage
+                  INNER JOIN Artefact
+                  ON Artefact.artefact_id = ArtefactImage.artefact_id
+                  INNER JOIN "user"
+                  ON "user".id = Artefact.owner
+                  WHERE "user".family_id = %(family_id)s
+                  ORDER BY ArtefactImage.artefact_id, ArtefactImage.image_id'''
+
+    for row in pg_stream(sql, {'family_id': family_id}, itersize):
+        yield ArtefactImage(*row)
+
+
+def iter_family_images(family_id, page_size=DB_PAGE_SIZE) -> Iterator[ArtefactImage]:
+    ''' The family's images, in iter_artefact_images' order, but read a page
+        at a time rather than streamed, so it's fine to be slow with each.
+        The URLs are S3 keys, not presigned.
+    '''
+    sql = f'''SELECT {IMAGE_COLUMNS}
+              FROM ArtefactImage
+              INNER JOIN Artefact
+              ON Artefact.artefact_id = ArtefactImage.artefact_id
+              INNER JOIN "user"
+              ON "user".id = Artefact.owner
+              WHERE "user".family_id = %(family_id)s
+                AND (ArtefactImage.artefact_id, ArtefactImage.image_id)
+                    > (%(after_artefact_id)s, %(after_image_id)s)
+              ORDER BY ArtefactImage.artefact_id, ArtefactImage.image_id
+              LIMIT %(limit)s'''
+
+    where = {'family_id': family_id, 'after_artefact_id': 0, 'after_image_id': 0,
+             'limit': page_size}
+    while True:
+        images = [ArtefactImage(*row) for row in pg_select(sql, where)]
+        yield from images
+        if len(images) < page_size:
+            return
+        where['after_artefact_id'] = images[-1].artefact_id
+        where['after_image_id'] = images[-1].image_id
+
+
+# An artefact along with its owner, where it's kept, its images and tags,
+# and whether a member of %(family_id)s may see it. Add a WHERE clause.
+ARTEFACT_DETAIL_SQL = f'''
+    SELECT {ARTEFACT_COLUMNS},
+        owner.id, owner.first_name, owner.surname,
+        owner.family_id = %(family_id)s,
+        CASE WHEN Artefact.stored_with = 'user'
+             THEN keeper.location
+             ELSE Artefact.stored_at_loc
+        END,
+        COALESCE((
+            SELECT json_agg(json_build_array({IMAGE_COLUMNS})
+                            ORDER BY image_id)
+            FROM ArtefactImage
+            WHERE ArtefactImage.artefact_id = Artefact.artefact_id
+        ), '[]'),
+        COALESCE((
+            SELECT json_agg(json_build_array(Tag.tag_id, Tag.name)
+                            ORDER BY Tag.name)
+            FROM ArtefactTaggedWith
+            INNER JOIN Tag
+            ON Tag.tag_id = ArtefactTaggedWith.tag_id
+            WHERE ArtefactTaggedWith.artefact_id = Artefact.artefact_id
+        ), '[]'),
+        EXISTS (
+            SELECT 1 FROM Job
+            WHERE Job.artefact_id = Artefact.artefact_id
+              AND Job.status IN ('queued', 'running')
+        )
+    FROM Artefact
+    INNER JOIN "user" AS owner
+    ON owner.id = Artefact.owner
+    LEFT JOIN "user" AS keeper
+    ON keeper.id = Artefact.stored_with_user'''
+
+def row_to_artefact_detail(row: Tuple, sign_images=True) -> ArtefactDetail:
+    artefact = Artefact(*row[0:8])
+    owner = User(*row[8:11])
+    viewer_has_access, location, images, tags, media_pending = row[11:16]
+
+    # don't bother signing image URLs for someone who can't see them
+    if not viewer_has_access:
+        images = []
+    elif sign_images:
+        images = [img_with_presigned_url(ArtefactImage(*img)) for img in images]
+    else:
+        images = [ArtefactImage(*img) for img in images]
+
+    return ArtefactDetail(artefact=artefact,
+                          owner=owner,
+                          location=location,
+                          images=images,
+                          tags=[Tag(*tag) for tag in tags],
+                          viewer_has_access=viewer_has_access,
+                          media_pending=media_pending)
+
+
+def get_artefact_detail(artefact_id: int, viewer_family_id) -> ArtefactDetail:
+    ''' Loads an artefact along with its owner, where it's kept, its images
+        and tags, and whether a member of viewer_family_id may see it, in a
+        single query. Returns None if there is no such artefact.
+    '''
+
+    sql = ARTEFACT_DETAIL_SQL + '''
+    WHERE Artefact.artefact_id = %(artefact_id)s'''
+
+    rows = pg_select(sql, {'artefact_id': artefact_id,
+                           'family_id': viewer_family_id})
+    if not rows:
+        return None
+    [row] = rows
+
+    return row_to_artefact_detail(row)
+
+
+def iter_artefact_details(family_id, page_size=DB_PAGE_SIZE) -> Iterator[ArtefactDetail]:
+    ''' The details of every artefact of the family, in id order, read a
+        page at a time. The image URLs are S3 keys, not presigned.
+    '''
+
+    sql = ARTEFACT_DETAIL_SQL + '''
+    WHERE owner.family_id = %(family_id)s
+      AND Artefact.artefact_id > %(after)s
+    ORDER BY Artefact.artefact_id
+    LIMIT %(limit)s'''
+
+    where = {'family_id': family_id, 'after': 0, 'limit': page_size}
+    while True:
+        details = [row_to_artefact_detail(row, sign_images=False)
+                   for row in pg_select(sql, where)]
+        yield from details
+        if len(details) < page_size:
+            return
+        where['after'] = details[-1].artefact.artefact_id
+
+
 def add_artefact(artefact: Artefact) -> int:
     '''returns the id of the newly inserted artefact'''
     
@@ -219,26 +536,100 @@ def add_artefact(artefact: Artefact) -> int:
             VALUES (%(name)s, %(owner)s, %(description)s, CURRENT_TIMESTAMP, %(stored_with)s, %(stored_with_user)s, %(stored_at_loc)s)
             RETURNING artefact_id;'''
 
-    with psycopg2.connect(current_app.config['db_URL']) as conn:
+    with db_conn() as conn:
         cur = conn.cursor()        
 
         cur.execute(sql, artefact._asdict())
         (artefact_id,) = cur.fetchone()
+        update_search_vectors(cur, [artefact_id])
+        touch_artefacts(cur, [artefact_id])
         return artefact_id
 
 
-def edit_artefact_db(artefact: Artefact):
-    ''' changes a new artefact '''
+def edit_artefact_db(artefact: Artefact, cover_image_id: int = None):
+    ''' changes a new artefact, and makes cover_image_id its cover if given.
+        Raises ValueError, changing nothing, if that isn't one of the
+        artefact's images.
+    '''
 
     sql = '''UPDATE Artefact
              SET name = %(name)s, description = %(description)s, stored_with_user = %(stored_with_user)s, stored_at_loc = %(stored_at_loc)s, stored_with = %(stored_with)s
              WHERE artefact_id = %(artefact_id)s;'''
 
-    with psycopg2.connect(current_app.config['db_URL']) as conn:
+    with db_conn() as conn:
         cur = conn.cursor()
 
         cur.execute(sql, artefact._asdict())
 
+        if cover_image_id is not None:
+            cur.execute('''UPDATE Artefact
+                           SET cover_image_id = %(image_id)s
+                           WHERE artefact_id = %(artefact_id)s
+                             AND EXISTS (SELECT 1 FROM ArtefactImage
+                                         WHERE image_id = %(image_id)s
+                                           AND artefact_id = %(artefact_id)s)''',
+                        {'artefact_id': artefact.artefact_id, 'image_id': cover_image_id})
+            if cur.rowcount == 0:
+                # rolls back the edit too
+                raise ValueError("cover image isn't one of the artefact's images")
+
+        update_search_vectors(cur, [artefact.artefact_id])
+        touch_artefacts(cur, [artefact.artefact_id])
+
+
+def update_search_vectors(cur, artefact_ids: [int]):
+    ''' Recomputes what the artefacts are found by in searches. Call it on
+        the cursor that changed their name, description or tags, so it
+        happens in the same transaction.
+    '''
+    cur.execute('''UPDATE Artefact
+                   SET search_vector = artefact_search_vector(artefact_id)
+                   WHERE artefact_id IN %s''', (tuple(artefact_ids),))
+
+
+def touch_artefacts(cur, artefact_ids: [int]):
+    ''' Marks the artefacts, and the grids of the families that own them, as
+        changed, so browsers fetch the pages again rather than reusing their
+        copies. Call it on the cursor making the change.
+    '''
+    inputs = {"artefact_ids": tuple(artefact_ids)}
+
+    # the new version would miss anyway; this just frees the memory
+    for artefact_id in artefact_ids:
+        for is_owner in (True, False):
+            card_cache.pop((artefact_id, is_owner))
+
+    cur.execute('''UPDATE Artefact
+                   SET updated_at = now()
+                   WHERE artefact_id IN %(artefact_ids)s''', inputs)
+    cur.execute('''UPDATE Family
+                   SET revision = revision + 1
+                   WHERE family_id IN (
+                       SELECT "user".family_id
+                       FROM Artefact
+                       INNER JOIN "user"
+                       ON "user".id = Artefact.owner
+                       WHERE Artefact.artefact_id IN %(artefact_ids)s)''', inputs)
+
+
+def get_artefact_version(artefact_id: int, viewer_family_id) -> Tuple[datetime, bool]:
+    ''' When the artefact last changed, and whether a member of
+        viewer_family_id may see it. None if there's no such artefact.
+    '''
+    sql = '''SELECT Artefact.updated_at, "user".family_id = %(family_id)s
+             FROM Artefact
+             INNER JOIN "user"
+             ON "user".id = Artefact.owner
+             WHERE Artefact.artefact_id = %(artefact_id)s'''
+
+    rows = pg_select(sql, {'artefact_id': artefact_id, 'family_id': viewer_family_id})
+    return rows[0] if rows else None
+
+
+def get_family_revision(family_id) -> int:
+    rows = pg_select('SELECT revision FROM Family WHERE family_id = %s', (family_id,))
+    return rows[0][0] if rows else None
+
 
 ''' Determines if an email is taken in the database, if not returns the  '''
 def email_taken(credentials: Credentials):
@@ -249,58 +640,341 @@ def email_taken(credentials: Credentials):
         LIMIT 1;'''
 
     # Returns user, if none with email returns None
-    with psycopg2.connect(current_app.config['db_URL']) as conn:
+    with db_conn() as conn:
         cur = conn.cursor()
         cur.execute(sql, credentials._asdict())
         return cur.fetchone()
 
 
+# Rows of logged in users, so that the burst of requests a page makes doesn't
+# load the user for each one. Anything that changes a user's row must pop it
+# from here, but that only reaches this worker's copy: the others keep the
+# old row (and build ETags from it) until it expires, so keep the TTL short.
+user_cache = TTLCache(maxsize=int(os.environ.get("USER_CACHE_SIZE", 1000)),
+                      ttl=float(os.environ.get("USER_CACHE_TTL", 5)))
+
+def get_user_row(user_id: int):
+    ''' Returns the user's row, as email_taken does, or None if there's no
+        such user. The password hash is left out, since the row is kept in
+        memory.
+    '''
+    row = user_cache.get(user_id)
+    if row is not None:
+        return row
+
+    sql = '''SELECT *
+        FROM "user"
+        WHERE id=%(user_id)s
+        LIMIT 1;'''
+
+    rows = pg_select(sql, {"user_id": user_id})
+    if not rows:
+        return None
+
+    row = rows[0][:3] + (None,) + rows[0][4:]
+    user_cache.set(user_id, row)
+    return row
 
 ''' Adds new user to the Database '''
 def register_user(register: Register):
 
     sql = '''INSERT INTO "user"
             (first_name, surname, email, password, location, family_id)
-            VALUES (%(first_name)s, %(surname)s, %(email)s, %(password)s, %(location)s, %(family_id)s);'''
-    with psycopg2.connect(current_app.config['db_URL']) as conn:
+            VALUES (%(first_name)s, %(surname)s, %(email)s, %(password)s, %(location)s, %(family_id)s)
+            RETURNING id;'''
+    with db_conn() as conn:
         cur = conn.cursor()
         cur.execute(sql, register._asdict())
+        (user_id,) = cur.fetchone()
+
+    user_cache.pop(user_id)
+    family_cache.pop(register.family_id)
 
 #############
 # Amazon S3 #
 #############
-s3 = boto3.resource('s3')
+S3_BUCKET = os.environ.get("S3_BUCKET", "shell-safe")
+
+# the most keys S3 will accept in one DeleteObjects request
+S3_DELETE_BATCH = 1000
+
+# how many images from one request are uploaded to S3 at a time
+S3_UPLOAD_WORKERS = int(os.environ.get("S3_UPLOAD_WORKERS", 4))
+
+# Images are sent to S3 in parts of this many bytes, so uploading one never
+# holds more than a part in memory. S3 won't take parts under 5MB (except the
+# last).
+S3_MIN_PART_SIZE = 5 * 1024 * 1024
+S3_PART_SIZE = max(int(os.environ.get("S3_PART_SIZE", 8 * 1024 * 1024)),
+                   S3_MIN_PART_SIZE)
+
+def upload_image(img, s3key, part_size=None):
+    ''' Streams an image (a FileStorage or any file-like object) to S3.
+
+        An image smaller than one part goes up in a single PUT. Anything
+        bigger is sent as a multipart upload, reading and sending one part
+        at a time, so memory use doesn't grow with the size of the image.
+    '''
+    part_size = max(part_size or S3_PART_SIZE, S3_MIN_PART_SIZE)
+    client = get_s3_client()
+
+    extra = {}
+    if getattr(img, 'mimetype', None):
+        extra['ContentType'] = img.mimetype
 
-def print_buckets():
-    for bucket in s3.buckets.all():
-        print(bucket.name)
+    stream = getattr(img, 'stream', img)
 
-def upload_image(img, s3key):
-    bucket = s3.Bucket('shell-safe')
-    bucket.put_object(Key=s3key, Body=img)
+    chunk = read_part(stream, part_size)
+    if len(chunk) < part_size:
+        client.put_object(Bucket=S3_BUCKET, Key=s3key, Body=chunk, **extra)
+        return
+
+    upload_id = client.create_multipart_upload(
+            Bucket=S3_BUCKET, Key=s3key, **extra)['UploadId']
+
+    try:
+        parts = []
+        while chunk:
+            part_number = len(parts) + 1
+            response = client.upload_part(Bucket=S3_BUCKET,
+                                          Key=s3key,
+                                          UploadId=upload_id,
+                                          PartNumber=part_number,
+                                          Body=chunk)
+            parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+            chunk = read_part(stream, part_size)
+
+        client.complete_multipart_upload(Bucket=S3_BUCKET,
+                                         Key=s3key,
+                                         UploadId=upload_id,
+                                         MultipartUpload={'Parts': parts})
+    except BaseException:
+        # otherwise S3 keeps (and bills us for) the parts already sent
+        client.abort_multipart_upload(Bucket=S3_BUCKET,
+                                      Key=s3key,
+                                      UploadId=upload_id)
+        raise
+
+def read_part(stream, size: int) -> bytes:
+    ''' Reads up to size bytes, only returning fewer at the end of the stream '''
+    chunks = []
+    remaining = size
+    while remaining > 0:
+        chunk = stream.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
+
+def upload_images(artefact_id: int, uploads: [Tuple[FileStorage, str]]) -> Tuple[List[ArtefactImage], List[Tuple[FileStorage, Exception]]]:
+    ''' Uploads each (img, s3key) pair, several at a time.
+
+        Returns an ArtefactImage (not yet in the database) for each image
+        that was uploaded, and the images that weren't along with what went
+        wrong. One failed upload doesn't stop the others.
+
+        Renditions aren't made here; see derive_image_renditions.
+    '''
+    if len(uploads) == 0:
+        return [], []
+
+    workers = min(S3_UPLOAD_WORKERS, len(uploads))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [(img, s3key, executor.submit(upload_image, img, s3key))
+                   for (img, s3key) in uploads]
+
+        uploaded, failed = [], []
+        for img, s3key, future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                logging.error(f"couldn't upload {s3key} to S3: {e}")
+                failed.append((img, e))
+                continue
+
+            uploaded.append(ArtefactImage(image_id=None,
+                                          artefact_id=artefact_id,
+                                          image_url=s3key,
+                                          image_description=None))
+
+    return uploaded, failed
+
+def derive_image_renditions(image_id: int):
+    ''' Makes the renditions of an image that's already in S3 and the
+        database, uploads them, and records them against the image. Slow, so
+        it runs as a background job rather than in the upload request.
+
+        An image Pillow can't read just goes without renditions.
+    '''
+    rows = pg_select('''SELECT image_url FROM ArtefactImage
+                         WHERE image_id = %(image_id)s''', {'image_id': image_id})
+    if not rows:
+        # the artefact was deleted before we got to it
+        return
+    [(s3key,)] = rows
+
+    # spooled, so a huge original goes to disk instead of sitting in memory
+    with SpooledTemporaryFile(max_size=S3_PART_SIZE) as original:
+        get_s3_client().download_fileobj(S3_BUCKET, s3key, original)
+        original.seek(0)
+
+        try:
+            renditions = make_renditions(original)
+        except (OSError, ValueError, Image.DecompressionBombError) as e:
+            logging.warning(f"couldn't make renditions of {s3key}: {e}")
+            return
+
+    client = get_s3_client()
+    keys = {}
+    for name, data in renditions.items():
+        key = rendition_key(s3key, name)
+        client.put_object(Bucket=S3_BUCKET, Key=key, Body=data,
+                          ContentType='image/jpeg')
+        keys[name] = key
+
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute('''UPDATE ArtefactImage
+                       SET thumb_url = %(thumb)s, medium_url = %(medium)s
+                       WHERE image_id = %(image_id)s''',
+                    {'thumb': keys.get('thumb'),
+                     'medium': keys.get('medium'),
+                     'image_id': image_id})
+
+# Longest edge in pixels of each smaller copy we keep of an image. Thumbnails
+# are for the artefact cards, medium for the artefact page.
+RENDITION_SIZES = {'thumb': 400, 'medium': 1200}
+
+def rendition_key(s3key: str, rendition: str) -> str:
+    ''' Renditions live next to the original: foo.png -> foo.thumb.jpg '''
+    stem = s3key.rsplit('.', 1)[0]
+    return f'{stem}.{rendition}.jpg'
+
+def make_renditions(stream) -> Dict[str, bytes]:
+    ''' Returns each rendition of the image as JPEG data '''
+    img = Image.open(stream)
+
+    # Lets the JPEG decoder skip detail we're about to throw away anyway,
+    # which is much faster and lighter than decoding the full image.
+    img.draft('RGB', (max(RENDITION_SIZES.values()),) * 2)
+
+    # phone photos are often stored sideways with an EXIF rotation tag
+    img = ImageOps.exif_transpose(img).convert('RGB')
+
+    renditions = {}
+    for name, size in sorted(RENDITION_SIZES.items(), key=lambda r: -r[1]):
+        img.thumbnail((size, size))
+        out = BytesIO()
+        img.save(out, 'JPEG', quality=80, optimize=True)
+        renditions[name] = out.getvalue()
+
+    return renditions
+
+def delete_images(s3keys: [str]):
+    ''' Deletes objects from the bucket, up to a thousand per request.
+        Failures are logged rather than raised: by the time we get here the
+        database no longer refers to these objects, so the worst case is an
+        orphaned file.
+    '''
+    client = get_s3_client()
+
+    for i in range(0, len(s3keys), S3_DELETE_BATCH):
+        batch = s3keys[i:i + S3_DELETE_BATCH]
+        try:
+            response = client.delete_objects(
+                    Bucket=S3_BUCKET,
+                    Delete={'Objects': [{'Key': key} for key in batch],
+                            'Quiet': True})
+        except ClientError as e:
+            logging.error(e)
+            continue
+
+        for error in response.get('Errors', []):
+            logging.error(f"couldn't delete {error['Key']} from S3: {error['Message']}")
 
 def add_image(artefact_image: ArtefactImage):
-    with psycopg2.connect(current_app.config['db_URL']) as conn:
+    add_images([artefact_image])
+
+def add_images(artefact_images: [ArtefactImage]) -> [int]:
+    ''' Inserts all the images with a single multi-row INSERT. Returns their
+        new image_ids, in the same order.
+    '''
+
+    if len(artefact_images) == 0:
+        return []
+
+    with db_conn() as conn:
         cur = conn.cursor()
         sql = '''INSERT INTO ArtefactImage
-                 (artefact_id, image_url, image_description)
-                 VALUES (%(artefact_id)s, %(image_url)s, %(image_description)s);'''
-
-        cur.execute(sql, artefact_image._asdict())
+                 (artefact_id, image_url, image_description, thumb_url, medium_url)
+                 VALUES %s
+                 RETURNING image_id;'''
+
+        rows = psycopg2.extras.execute_values(
+                cur, sql,
+                [img._asdict() for img in artefact_images],
+                template='''(%(artefact_id)s, %(image_url)s, %(image_description)s,
+                            %(thumb_url)s, %(medium_url)s)''',
+                page_size=len(artefact_images),
+                fetch=True)
+        artefact_ids = tuple({img.artefact_id for img in artefact_images})
+
+        # the first image an artefact gets is its cover until the owner
+        # picks another
+        cur.execute('''UPDATE Artefact
+                       SET cover_image_id = (
+                           SELECT MIN(image_id) FROM ArtefactImage
+                           WHERE ArtefactImage.artefact_id = Artefact.artefact_id)
+                       WHERE artefact_id IN %s
+                         AND cover_image_id IS NULL''', (artefact_ids,))
+
+        touch_artefacts(cur, artefact_ids)
+        return [row[0] for row in rows]
 
 def get_artefact_images_metadata(artefact_id: int) -> [ArtefactImage]:
-    rows = pg_select('SELECT * FROM ArtefactImage WHERE artefact_id = %s;',
+    rows = pg_select(f'SELECT {IMAGE_COLUMNS} FROM ArtefactImage WHERE artefact_id = %s;',
             (artefact_id, ))
     return [img_with_presigned_url(ArtefactImage(*row)) for row in rows]
 
 
+def get_cover_image_id(artefact_id: int):
+    rows = pg_select('SELECT cover_image_id FROM Artefact WHERE artefact_id = %s',
+                     (artefact_id,))
+    return rows[0][0] if rows else None
+
+
 def generate_img_filename(user_id: str, img: FileStorage):
     name, ext = img.filename.rsplit('.',1)
     timestamp = datetime.utcnow().isoformat().replace(":", "_")
     return f'{user_id}-{name}-{timestamp}.{ext}'
 
+# how long the image URLs we hand out stay valid, in seconds
+PRESIGNED_URL_EXPIRATION = 3600
+
+# Presigned URLs are handed out from this cache for at most half of their
+# lifetime, so a page that sits open in a browser for a while can still load
+# its images.
+presigned_url_cache = TTLCache(
+        maxsize=int(os.environ.get("PRESIGNED_URL_CACHE_SIZE", 10000)),
+        ttl=PRESIGNED_URL_EXPIRATION / 2)
+
+_s3_clients = {}
+_s3_clients_lock = threading.Lock()
+
+def get_s3_client():
+    ''' Returns this worker process's long-lived S3 client. Building a client
+        is far more expensive than signing a URL with one, and unlike
+        resources, clients are safe to share between threads.
+    '''
+    pid = os.getpid()
+    with _s3_clients_lock:
+        if pid not in _s3_clients:
+            _s3_clients[pid] = instrument_s3_client(boto3.client('s3'))
+        return _s3_clients[pid]
+
 # from https://boto3.amazonaws.com/v1/documentation/api/latest/guide/s3-presigned-urls.html
-def create_presigned_url(object_name, expiration=3600):
+def create_presigned_url(object_name, expiration=PRESIGNED_URL_EXPIRATION):
     """Generate a presigned URL to share an S3 object
 
     :param object_name: string
@@ -308,29 +982,43 @@ def create_presigned_url(object_name, expiration=3600):
     :return: Presigned URL as string. If error, returns None.
     """
 
+    key = (object_name, expiration)
+    url = presigned_url_cache.get(key)
+    if url is not None:
+        return url
+
     # Generate a presigned URL for the S3 object
-    s3_client = boto3.client('s3')
+    start = time.perf_counter()
     try:
-        response = s3_client.generate_presigned_url('get_object',
-                                                    Params={'Bucket': "shell-safe",
-                                                            'Key': object_name},
-                                                    ExpiresIn=expiration)
+        url = get_s3_client().generate_presigned_url('get_object',
+                                                     Params={'Bucket': S3_BUCKET,
+                                                             'Key': object_name},
+                                                     ExpiresIn=expiration)
     except ClientError as e:
         logging.error(e)
         return None
+    finally:
+        # signing happens locally, so the client's hooks don't see it
+        record_s3_call('GeneratePresignedUrl', time.perf_counter() - start)
+
+    presigned_url_cache.set(key, url, ttl=expiration / 2)
 
     # The response contains the presigned URL
-    return response
+    return url
 
 def img_with_presigned_url(artefact_image: ArtefactImage) -> ArtefactImage:
     '''Convert the "image_url" in the ArtefactImage from an S3 Object key (how
        it is stored in the DB) to a presigned URL suitable for the frontend to
        GET.
     '''
-    return ArtefactImage(artefact_image.image_id,
-                         artefact_image.image_id,
-                         create_presigned_url(artefact_image.image_url),
-                         artefact_image.image_description)
+    return artefact_image._replace(
+            image_url=create_presigned_url(artefact_image.image_url),
+            thumb_url=(create_presigned_url(artefact_image.thumb_url)
+                       if artefact_image.thumb_url is not None
+                       else None),
+            medium_url=(create_presigned_url(artefact_image.medium_url)
+                        if artefact_image.medium_url is not None
+                        else None))
 
 def create_family(family_name):
 
@@ -356,7 +1044,7 @@ def create_family(family_name):
              (name, referral_code)
              VALUES (%(family_name)s, %(referral_code)s);'''
 
-    with psycopg2.connect(current_app.config['db_URL']) as conn:
+    with db_conn() as conn:
         cur = conn.cursor()
 
         cur.execute(sql, inputs)
@@ -385,92 +1073,84 @@ def get_referral_code(family_id):
 
 ''' Removes an artefacts tags then images then the artefact '''
 def remove_artefact(artefact_id):
+    remove_artefacts([artefact_id])
 
-    inputs = {"artefact_id": artefact_id}
-
-    sql = '''DELETE FROM artefacttaggedwith
-             WHERE artefact_id = %(artefact_id)s;'''
-
-    with psycopg2.connect(current_app.config['db_URL']) as conn:
-        cur = conn.cursor()
-        cur.execute(sql, inputs)
+def remove_artefacts(artefact_ids: [int]):
+    ''' Removes the artefacts' tags, then images, then the artefacts
+        themselves, all in one transaction. Once that has committed, the
+        image files are deleted from S3.
+    '''
 
-    sql = '''DELETE FROM artefactimage
-             WHERE artefact_id = %(artefact_id)s;'''
+    if len(artefact_ids) == 0:
+        return
 
-    with psycopg2.connect(current_app.config['db_URL']) as conn:
-        cur = conn.cursor()
-        cur.execute(sql, inputs)
+    inputs = {"artefact_ids": tuple(artefact_ids)}
 
-    sql = '''DELETE FROM artefact
-             WHERE artefact_id = %(artefact_id)s;'''
-    with psycopg2.connect(current_app.config['db_URL']) as conn:
+    with db_conn() as conn:
         cur = conn.cursor()
-        cur.execute(sql, inputs)
-
-
-def get_user_loc(user_id):
-
-    inputs = {"user_id": user_id}
 
-    sql = '''SELECT location FROM "user"
-             WHERE id = %(user_id)s;'''
+        # while we can still find their families
+        touch_artefacts(cur, artefact_ids)
 
-    return pg_select(sql, inputs)[0][0]
+        cur.execute('''DELETE FROM artefacttaggedwith
+                       WHERE artefact_id IN %(artefact_ids)s;''', inputs)
 
-def get_user(user_id):
-    inputs = {"user_id": user_id}
+        cur.execute('''DELETE FROM artefactimage
+                       WHERE artefact_id IN %(artefact_ids)s
+                       RETURNING image_url, thumb_url, medium_url;''', inputs)
+        s3keys = [key for row in cur.fetchall() for key in row if key is not None]
 
-    sql = '''SELECT id, first_name, surname FROM "user"
-             WHERE id = %(user_id)s
-             LIMIT 1;'''
-    rows = pg_select(sql, inputs)
-    [user] = rows
+        cur.execute('''DELETE FROM artefact
+                       WHERE artefact_id IN %(artefact_ids)s;''', inputs)
 
-    return User(*user)
+    # If the transaction rolled back we never get here, so we can't delete
+    # images that are still referenced.
+    delete_images(s3keys)
 
-''' Inserts a tag into the database'''
-def insert_tag(tag_name):
-    
-    inputs = {"tag_name": tag_name}
 
-    sql = '''INSERT INTO tag
-            (name)
-            VALUES (%(tag_name)s)
-            RETURNING tag_id;'''
+def tag_artefact(artefact_id: int, tag_names: [str]) -> [Tag]:
+    ''' Tags an artefact with each of the named tags, creating any that
+        don't exist yet. Tags the artefact already has are left alone.
 
-    with psycopg2.connect(current_app.config['db_URL']) as conn:
-        
-        cur = conn.cursor()
-        cur.execute(sql, inputs)
-        return cur.fetchone()[0]
-
-def get_tags_by_names(tags):
-
-    sql = '''SELECT * FROM tag
-             WHERE name in %(name)s'''
-    rows = pg_select(sql, {'name': tuple(tags)})
-    tags = [Tag(*row) for row in rows]
-    return tags
-
-''' Pairs a tag with an artefact'''
-def pair_tag_to_artefact(artefact_id, tag_id):
+        This is one statement, so it happens in one transaction and one round
+        trip however many tags there are. Returns the tags now paired.
+    '''
 
     inputs = {"artefact_id": artefact_id,
-              "tag_id": tag_id}
-
-    sql = '''INSERT INTO artefacttaggedwith
-             (artefact_id, tag_id)
-             VALUES (%(artefact_id)s, %(tag_id)s)'''
-
-    with psycopg2.connect(current_app.config['db_URL']) as conn:
+              "names": list(set(tag_names))}
 
+    sql = '''
+    WITH wanted AS (
+        SELECT unnest(%(names)s::text[]) AS name
+    ), existing AS (
+        SELECT Tag.tag_id, Tag.name
+        FROM Tag
+        INNER JOIN wanted
+        ON wanted.name = Tag.name
+    ), inserted AS (
+        INSERT INTO Tag (name)
+        SELECT name FROM wanted
+        WHERE name NOT IN (SELECT name FROM existing)
+        ON CONFLICT DO NOTHING
+        RETURNING tag_id, name
+    ), tags AS (
+        SELECT tag_id, name FROM existing
+        UNION
+        SELECT tag_id, name FROM inserted
+    ), paired AS (
+        INSERT INTO ArtefactTaggedWith (artefact_id, tag_id)
+        SELECT %(artefact_id)s, tag_id FROM tags
+        ON CONFLICT DO NOTHING
+    )
+    SELECT tag_id, name FROM tags'''
+
+    with db_conn() as conn:
         cur = conn.cursor()
-
-        try:
-            cur.execute(sql, inputs)
-        except psycopg2.errors.UniqueViolation as e:
-            print(f'artefact {artefact_id} is already tagged with tag {tag_id}')
+        cur.execute(sql, inputs)
+        tags = [Tag(*row) for row in cur.fetchall()]
+        update_search_vectors(cur, [artefact_id])
+        touch_artefacts(cur, [artefact_id])
+        return tags
 
 
 def edit_user_details(user_id, details):
@@ -479,9 +1159,25 @@ def edit_user_details(user_id, details):
 
     sql = '''UPDATE "user"
              SET first_name = %(first_name)s, surname = %(surname)s, location = %(location)s
-             WHERE id = %(user_id)s;'''
+             WHERE id = %(user_id)s
+             RETURNING family_id;'''
 
-    with psycopg2.connect(current_app.config['db_URL']) as conn:
+    with db_conn() as conn:
         
         cur = conn.cursor()
         cur.execute(sql, inputs) 
+        row = cur.fetchone()
+
+        # their name is on the artefacts they own, and their address on the
+        # ones they keep
+        cur.execute('''SELECT artefact_id FROM Artefact
+                       WHERE owner = %(user_id)s OR stored_with_user = %(user_id)s''',
+                    inputs)
+        artefact_ids = [artefact_id for (artefact_id,) in cur.fetchall()]
+        if artefact_ids:
+            touch_artefacts(cur, artefact_ids)
+
+    user_cache.pop(user_id)
+    if row is not None:
+        # members' names are cached with the family
+        family_cache.pop(row[0])
@@ -0,0 +1,173 @@
+import os
+import threading
+import time
+
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict
+
+from flask import current_app
+import psycopg2
+
+from metrics import InstrumentedCursor
+
+
+class PoolTimeout(Exception):
+    ''' Raised when no connection became free within the checkout timeout '''
+
+
+class ConnectionPool:
+    ''' A bounded pool of psycopg2 connections, shared by the threads of one
+        worker process.
+
+        Connections are opened lazily, up to `size` of them. If they are all
+        checked out, getconn() waits up to `timeout` seconds for one to be
+        returned before giving up with PoolTimeout. A connection that has sat
+        idle for longer than `health_check_after` seconds is pinged before
+        being handed out, and replaced if the ping fails.
+    '''
+
+    def __init__(self, dsn: str, size=5, timeout=10.0, health_check_after=30.0):
+        self.dsn = dsn
+        self.size = size
+        self.timeout = timeout
+        self.health_check_after = health_check_after
+
+        # (connection, time.monotonic() when it was returned)
+        self._idle = deque()
+        self._in_use = 0
+        self._cond = threading.Condition()
+
+        # statistics
+        self.checkouts = 0
+        self.connections_opened = 0
+        self.wait_time = 0.0
+
+    def getconn(self):
+        start = time.monotonic()
+        deadline = start + self.timeout
+
+        with self._cond:
+            while not self._idle and self._in_use >= self.size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeout(
+                        f"no database connection free after {self.timeout}s")
+                self._cond.wait(remaining)
+
+            self.wait_time += time.monotonic() - start
+            self.checkouts += 1
+            self._in_use += 1
+            conn, returned_at = self._idle.pop() if self._idle else (None, None)
+
+        # Anything slow (pinging, connecting) happens outside the lock. The
+        # slot is already reserved, so give it back if we fail to fill it.
+        try:
+            if conn is not None and not self._healthy(conn, returned_at):
+                self._discard(conn)
+                conn = None
+
+            if conn is None:
+                conn = psycopg2.connect(self.dsn, cursor_factory=InstrumentedCursor)
+                with self._cond:
+                    self.connections_opened += 1
+        except BaseException:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+        return conn
+
+    def putconn(self, conn):
+        # A connection that is closed, or stuck mid-transaction, can't be
+        # handed to the next caller as-is.
+        if not conn.closed and conn.get_transaction_status() != \
+                psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                self._discard(conn)
+
+        with self._cond:
+            if not conn.closed:
+                self._idle.append((conn, time.monotonic()))
+            self._in_use -= 1
+            self._cond.notify()
+
+    def _healthy(self, conn, returned_at) -> bool:
+        if conn.closed:
+            return False
+        if time.monotonic() - returned_at < self.health_check_after:
+            return True
+
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def closeall(self):
+        with self._cond:
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._discard(conn)
+
+    def stats(self) -> Dict:
+        with self._cond:
+            return {
+                'size': self.size,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'checkouts': self.checkouts,
+                'connections_opened': self.connections_opened,
+                'handshakes_saved': self.checkouts - self.connections_opened,
+                'wait_time_total': self.wait_time,
+                'wait_time_avg': (self.wait_time / self.checkouts
+                                  if self.checkouts else 0.0),
+            }
+
+
+# One pool per worker process. Connections must not be shared across a
+# fork, so the pool is keyed on the pid as well as the database URL.
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    config = current_app.config
+    key = (os.getpid(), config['db_URL'])
+
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(
+                    config['db_URL'],
+                    size=config.get('DB_POOL_SIZE', 5),
+                    timeout=config.get('DB_POOL_TIMEOUT', 10.0),
+                    health_check_after=config.get('DB_POOL_HEALTH_CHECK_AFTER', 30.0))
+        return _pools[key]
+
+
+@contextmanager
+def db_conn():
+    ''' Check a connection out of the pool for one transaction.
+
+        Like `with psycopg2.connect(...) as conn:`, the transaction is
+        committed if the block succeeds and rolled back if it raises, but the
+        connection is returned to the pool rather than left open.
+    '''
+    pool = get_pool()
+    conn = pool.getconn()
+    try:
+        with conn:
+            yield conn
+    finally:
+        pool.putconn(conn)
@@ -1,22 +1,62 @@
 from typing import List, Dict
-from model import Artefact, ArtefactImage, ArtefactUser, Tag
-from jinja2 import Template
+from model import Artefact, ArtefactImage, Tag
 from flask import render_template
+from markupsafe import Markup, escape
+
+from persistence import card_cache
+
+# Stands in for the image URL in cached cards. Signed URLs change, so they're
+# put in each time the card is used. Being markup, it can't be forged by
+# anything users type, which is escaped.
+IMAGE_SRC = Markup('<image-src>')
+
+def render_card(artefact_preview: Dict, is_owner: bool) -> Markup:
+    ''' The HTML of one card of the artefacts grid. Rendering the same card
+        over and over adds up on big grids, so it's cached until the
+        artefact's next change.
+    '''
+    key = (artefact_preview['artefact'].artefact_id, is_owner)
+    version = artefact_preview['updated_at']
+
+    cached = card_cache.get(key)
+    if cached is not None and cached[0] == version:
+        html = cached[1]
+    else:
+        html = render_template('artefact_card.html',
+                               artefact_preview=artefact_preview,
+                               is_owner=is_owner,
+                               image_src=IMAGE_SRC)
+        card_cache.set(key, (version, html))
+
+    image = artefact_preview['image']
+    if image is not None:
+        html = html.replace(IMAGE_SRC, str(escape(image.thumb_url or image.image_url)))
+    return Markup(html)
 
 def view_artefacts(artefact_previews: List[Dict],
                    user_id: int,
                    family_tags: List[Tag],
-                   filtered_tags: List[Tag] = None) -> str:
+                   filtered_tags: List[Tag] = None,
+                   next_url: str = None,
+                   prev_url: str = None,
+                   query: str = '') -> str:
+    cards = [render_card(preview, preview['artefact'].owner == user_id)
+             for preview in artefact_previews]
+
     return render_template('artefacts_template.html',
-                           artefact_previews=artefact_previews,
+                           cards=cards,
                            user_id=user_id,
                            family_tags=family_tags,
-                           filtered_tags=filtered_tags)
+                           filtered_tags=filtered_tags,
+                           next_url=next_url,
+                           prev_url=prev_url,
+                           query=query)
 
 def view_artefact(artefact: Artefact,
                   artefact_images: [ArtefactImage],
                   user_id,
                   artefact_loc,
                   owner,
-                  tags) -> str:
-    return render_template("artefact_view.html", artefact=artefact, artefact_images=artefact_images, user_id=user_id, artefact_loc=artefact_loc, owner=owner, tags=tags)
+                  tags,
+                  media_pending=False) -> str:
+    return render_template("artefact_view.html", artefact=artefact, artefact_images=artefact_images, user_id=user_id, artefact_loc=artefact_loc, owner=owner, tags=tags, media_pending=media_pending)
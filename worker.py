@@ -0,0 +1,15 @@
+''' Runs background jobs (see jobs.py). Started as the worker process in the
+    Procfile, alongside the web process.
+'''
+
+import logging
+
+from app import app
+from jobs import run_worker
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    # the persistence functions find the database through the app config
+    with app.app_context():
+        run_worker()